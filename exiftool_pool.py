@@ -0,0 +1,136 @@
+"""
+Persistent exiftool workers driven through -stay_open batch mode
+Shared by snapchat-downloader.py and metadata.py - starting Perl once per worker
+instead of once per file
+"""
+
+import atexit
+import queue
+import subprocess
+import threading
+
+EXIFTOOL = 'exiftool'
+CLOSE_TIMEOUT = 10  # Seconds to wait for a worker to exit cleanly
+
+class ExifToolProcess:
+    """
+    One long-lived `exiftool -stay_open True -@ -` process
+    Not thread-safe on its own - use it through ExifToolPool
+    """
+    
+    def __init__(self, executable=EXIFTOOL):
+        self.executable = executable
+        self.process = None
+        self._sequence = 0
+    
+    @property
+    def running(self):
+        return self.process is not None and self.process.poll() is None
+    
+    def start(self):
+        self.process = subprocess.Popen(
+            [self.executable, '-stay_open', 'True', '-@', '-'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            encoding='utf-8',
+            errors='replace'
+        )
+    
+    def _read_until(self, stream, marker):
+        """Reads lines until one ends with `marker` and returns everything before it"""
+        lines = []
+        while True:
+            line = stream.readline()
+            if not line:
+                raise BrokenPipeError("exiftool worker exited unexpectedly")
+            if line.rstrip('\r\n').endswith(marker):
+                lines.append(line.rstrip('\r\n')[:-len(marker)])
+                return ''.join(lines)
+            lines.append(line)
+    
+    def execute(self, *params):
+        """
+        Runs one exiftool command and returns a subprocess.CompletedProcess
+        Arguments are passed one per line, so they must not contain newlines
+        """
+        if not self.running:
+            self.start()
+        
+        self._sequence += 1
+        ready = f'{{ready{self._sequence}}}'
+        done = f'post{self._sequence}'
+        # -echo4 prints the exit status to stderr once the command has finished (exiftool 12.10+)
+        command = list(params) + ['-echo4', f'=${{status}}={done}', f'-execute{self._sequence}']
+        self.process.stdin.write('\n'.join(command) + '\n')
+        self.process.stdin.flush()
+        
+        stdout = self._read_until(self.process.stdout, ready)
+        stderr = self._read_until(self.process.stderr, done)
+        
+        # stderr ends with "=<status>="
+        returncode = 1 if 'Error' in stderr else 0
+        head, _, status = stderr.rstrip('=').rpartition('=')
+        if status.strip().isdigit():
+            returncode = int(status)
+            stderr = head
+        
+        return subprocess.CompletedProcess(params, returncode, stdout, stderr)
+    
+    def close(self):
+        if self.process is None:
+            return
+        try:
+            if self.running:
+                self.process.stdin.write('-stay_open\nFalse\n')
+                self.process.stdin.flush()
+                self.process.wait(timeout=CLOSE_TIMEOUT)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+        finally:
+            self.process = None
+
+class ExifToolPool:
+    """
+    Thread-safe pool of ExifToolProcess workers
+    Workers are started on first use (at most `size`) and restarted if they crash
+    """
+    
+    def __init__(self, size=1, executable=EXIFTOOL):
+        self.size = max(1, size)
+        self.executable = executable
+        self._idle = queue.Queue()
+        self._workers = []
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+    
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if len(self._workers) < self.size:
+                worker = ExifToolProcess(self.executable)
+                self._workers.append(worker)
+                return worker
+        return self._idle.get()
+    
+    def execute(self, *params):
+        """Runs one exiftool command on a free worker (see ExifToolProcess.execute)"""
+        worker = self._acquire()
+        try:
+            try:
+                return worker.execute(*params)
+            except OSError:
+                # The worker died mid-command - replace it and try once more
+                worker.close()
+                return worker.execute(*params)
+        finally:
+            self._idle.put(worker)
+    
+    def close(self):
+        with self._lock:
+            for worker in self._workers:
+                worker.close()
@@ -0,0 +1,328 @@
+"""
+Streaming parser for Snapchat's memories_history.html export
+Shared by snapchat-downloader.py and metadata.py
+"""
+
+import os
+import re
+import codecs
+import sqlite3
+import hashlib
+from html.parser import HTMLParser
+
+CHUNK_SIZE = 64 * 1024  # Bytes of HTML fed to the parser at a time
+MAX_REPORTED_PROBLEMS = 20  # Rows listed individually by print_integrity_report()
+INDEX_VERSION = 2  # Bump when the record layout changes to invalidate old caches
+MEMORIES_TABLE = ('CREATE TABLE IF NOT EXISTS memories '
+                  '(row INTEGER PRIMARY KEY, url TEXT, is_get INTEGER, unique_id TEXT, '
+                  'date TEXT, media_type TEXT, latitude REAL, longitude REAL, issues TEXT)')
+
+# downloadMemories('<url>', this, true|false) in the row's onclick handler
+DOWNLOAD_PATTERN = re.compile(r"downloadMemories\('(.+?)',\s*this,\s*(true|false)\)")
+# Pattern for coordinates: "Latitude, Longitude: 48.26275, 13.296288"
+COORD_PATTERN = re.compile(r'Latitude,\s*Longitude:\s*([+-]?\d+\.?\d*),\s*([+-]?\d+\.?\d*)')
+# Capture dates as exported: "2023-01-10 12:30:00 UTC"
+DATE_PATTERN = re.compile(r'^\d{4}-\d{2}-\d{2}( \d{2}:\d{2}:\d{2})?( UTC)?$')
+
+def extract_unique_id_from_url(url):
+    """Extracts the unique ID (mid) from the URL"""
+    mid_match = re.search(r'mid=([a-zA-Z0-9\-]+)', url)
+    if mid_match:
+        return mid_match.group(1)
+    else:
+        # Fallback: Hash of entire URL
+        return hashlib.md5(url.encode()).hexdigest()
+
+class MemoryRecord:
+    """
+    One row of the memories table
+    URL, date and location are joined at parse time, so a malformed row can never
+    shift the data of the rows after it
+    """
+    
+    __slots__ = ('row', 'url', 'is_get', 'unique_id', 'date', 'media_type',
+                 'latitude', 'longitude', 'issues')
+    
+    def __init__(self, row, url, is_get, unique_id, date, media_type,
+                 latitude=None, longitude=None, issues=()):
+        self.row = row
+        self.url = url
+        self.is_get = is_get
+        self.unique_id = unique_id
+        self.date = date
+        self.media_type = media_type
+        self.latitude = latitude
+        self.longitude = longitude
+        self.issues = tuple(issues)
+    
+    @property
+    def location(self):
+        """GPS coordinates as stored in metadata.json (None without coordinates)"""
+        if self.latitude is None or self.longitude is None:
+            return None
+        return {'latitude': self.latitude, 'longitude': self.longitude}
+    
+    def __eq__(self, other):
+        if not isinstance(other, MemoryRecord):
+            return NotImplemented
+        return all(getattr(self, field) == getattr(other, field) for field in self.__slots__)
+    
+    def __repr__(self):
+        return f"MemoryRecord(row={self.row}, unique_id={self.unique_id!r}, date={self.date!r})"
+
+def build_record(row, cells, download):
+    """Joins the cells and download link of one table row into a record"""
+    url, is_get = download if download else (None, None)
+    date = cells[0] if cells and cells[0] else None
+    latitude = longitude = None
+    issues = []
+    
+    # Search all cells for coordinates (only one location per row)
+    for text in cells:
+        match = COORD_PATTERN.search(text)
+        if match:
+            latitude = float(match.group(1))
+            longitude = float(match.group(2))
+            break
+    else:
+        if any('Latitude' in text for text in cells):
+            issues.append('unreadable location')
+    
+    if not url:
+        issues.append('no download link')
+    if not date:
+        issues.append('no date')
+    elif not DATE_PATTERN.match(date):
+        issues.append(f'unrecognised date {date!r}')
+    
+    return MemoryRecord(
+        row, url, is_get, extract_unique_id_from_url(url) if url else None, date,
+        cells[1] if len(cells) > 1 else None, latitude, longitude, issues
+    )
+
+def check_integrity(records):
+    """
+    Lists rows that cannot be aligned cleanly as (row, unique_id, issue) tuples
+    Covers problems found while parsing plus memories exported more than once
+    """
+    problems = []
+    first_row = {}
+    for record in records:
+        for issue in record.issues:
+            problems.append((record.row, record.unique_id, issue))
+        if record.unique_id:
+            if record.unique_id in first_row:
+                problems.append((record.row, record.unique_id,
+                                 f'duplicate of row {first_row[record.unique_id]}'))
+            else:
+                first_row[record.unique_id] = record.row
+    return problems
+
+def print_integrity_report(problems):
+    """Prints the rows found by check_integrity() (nothing if every row is fine)"""
+    if not problems:
+        return
+    print(f"⚠️  {len(problems)} row(s) in the export could not be aligned cleanly:")
+    for row, unique_id, issue in problems[:MAX_REPORTED_PROBLEMS]:
+        print(f"   Row {row}{f' ({unique_id})' if unique_id else ''}: {issue}")
+    if len(problems) > MAX_REPORTED_PROBLEMS:
+        print(f"   ... and {len(problems) - MAX_REPORTED_PROBLEMS} more")
+    print()
+
+class MemoriesTableParser(HTMLParser):
+    """
+    Incremental parser for the memories table (body > div.rightpanel > table)
+    Completed rows are collected in `rows` and drained by iter_memories()
+    """
+    
+    def __init__(self):
+        super().__init__()
+        self.rows = []
+        self._row_count = 0  # Data rows seen so far (1-based row numbers)
+        self._panel_depth = 0  # > 0 while inside div.rightpanel
+        self._in_row = False
+        self._cells = []
+        self._cell_text = None  # Stripped text nodes while inside a <td>
+        self._text_node = []  # Raw pieces of the current text node (may span chunks)
+        self._download = None
+    
+    def _end_text_node(self):
+        # Like BeautifulSoup's get_text(strip=True): strip each text node, then join
+        if self._text_node:
+            self._cell_text.append(''.join(self._text_node).strip())
+            self._text_node = []
+    
+    def handle_starttag(self, tag, attrs):
+        if self._cell_text is not None:
+            self._end_text_node()
+        
+        if tag == 'div':
+            if self._panel_depth:
+                self._panel_depth += 1
+            elif 'rightpanel' in (dict(attrs).get('class') or '').split():
+                self._panel_depth = 1
+            return
+        
+        if not self._panel_depth:
+            return
+        
+        if tag == 'tr':
+            self._in_row = True
+            self._cells = []
+            self._cell_text = None
+            self._download = None
+        elif tag == 'td' and self._in_row:
+            self._cell_text = []
+        
+        # The download link sits in an onclick handler somewhere inside the row
+        if self._in_row and self._download is None:
+            for _, value in attrs:
+                if value and 'downloadMemories' in value:
+                    match = DOWNLOAD_PATTERN.search(value)
+                    if match:
+                        self._download = (match.group(1), match.group(2) == 'true')
+                        break
+    
+    def handle_endtag(self, tag):
+        if self._cell_text is not None:
+            self._end_text_node()
+        
+        if tag == 'div':
+            if self._panel_depth:
+                self._panel_depth -= 1
+            return
+        
+        if not self._panel_depth or not self._in_row:
+            return
+        
+        if tag == 'td' and self._cell_text is not None:
+            self._cells.append(''.join(self._cell_text).strip())
+            self._cell_text = None
+        elif tag == 'tr':
+            # Header rows only contain <th> cells
+            if self._cells:
+                self._row_count += 1
+                self.rows.append(build_record(self._row_count, self._cells, self._download))
+            self._in_row = False
+    
+    def handle_data(self, data):
+        if self._cell_text is not None:
+            self._text_node.append(data)
+
+def iter_memories(html_file, chunk_size=CHUNK_SIZE, digest=None):
+    """
+    Yields one record per table row of memories_history.html in a single pass
+    Memory use stays flat: the file is fed in chunks and rows are yielded as they complete
+    If `digest` (a hashlib object) is given, it is updated with the raw bytes on the way
+    """
+    parser = MemoriesTableParser()
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    with open(html_file, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            if digest is not None:
+                digest.update(chunk)
+            parser.feed(decoder.decode(chunk))
+            if parser.rows:
+                yield from parser.rows
+                parser.rows = []
+    parser.feed(decoder.decode(b'', final=True))
+    parser.close()
+    yield from parser.rows
+
+def get_index_path(html_file):
+    """The parsed-manifest cache lives next to the export"""
+    return os.path.splitext(html_file)[0] + '.index.db'
+
+def hash_file(filepath, chunk_size=1024 * 1024):
+    """SHA256 of a file"""
+    sha256_hash = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_size), b''):
+            sha256_hash.update(block)
+    return sha256_hash.hexdigest()
+
+def read_index(conn, html_file, stat_info):
+    """Returns the cached records if the index matches the export, else None"""
+    conn.execute('CREATE TABLE IF NOT EXISTS source '
+                 '(id INTEGER PRIMARY KEY CHECK (id = 1), version INTEGER, '
+                 'size INTEGER, mtime_ns INTEGER, sha256 TEXT)')
+    conn.execute(MEMORIES_TABLE)
+    source = conn.execute('SELECT version, size, mtime_ns, sha256 FROM source').fetchone()
+    if not source or source[0] != INDEX_VERSION or source[1] != stat_info.st_size:
+        return None
+    
+    if source[2] != stat_info.st_mtime_ns:
+        # Touched or copied, but maybe not changed - only the hash can tell
+        if hash_file(html_file) != source[3]:
+            return None
+        with conn:
+            conn.execute('UPDATE source SET mtime_ns = ?', (stat_info.st_mtime_ns,))
+    
+    records = []
+    for row, url, is_get, unique_id, date, media_type, latitude, longitude, issues in conn.execute(
+            'SELECT row, url, is_get, unique_id, date, media_type, latitude, longitude, issues '
+            'FROM memories ORDER BY row'):
+        records.append(MemoryRecord(
+            row, url, bool(is_get) if is_get is not None else None, unique_id, date, media_type,
+            latitude, longitude, issues.split('\n') if issues else ()
+        ))
+    return records
+
+def write_index(conn, stat_info, sha256, records):
+    """Replaces the cached records in a single transaction"""
+    with conn:
+        # Recreate the table so caches written by an older INDEX_VERSION are upgraded too
+        conn.execute('DROP TABLE IF EXISTS memories')
+        conn.execute(MEMORIES_TABLE)
+        conn.execute('DELETE FROM source')
+        conn.executemany(
+            'INSERT INTO memories (row, url, is_get, unique_id, date, media_type, latitude, longitude, issues) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            ((r.row, r.url, r.is_get, r.unique_id, r.date, r.media_type, r.latitude, r.longitude,
+              '\n'.join(r.issues)) for r in records)
+        )
+        conn.execute('INSERT INTO source (id, version, size, mtime_ns, sha256) VALUES (1, ?, ?, ?, ?)',
+                     (INDEX_VERSION, stat_info.st_size, stat_info.st_mtime_ns, sha256))
+
+def load_memories(html_file, use_cache=True):
+    """
+    Returns all table rows of the export and whether they came from the index cache
+    The cache is keyed by size, mtime and SHA256 of the export, so dropping in a new
+    memories_history.html invalidates it automatically
+    """
+    stat_info = os.stat(html_file)
+    conn = None
+    if use_cache:
+        try:
+            conn = sqlite3.connect(get_index_path(html_file))
+            records = read_index(conn, html_file, stat_info)
+            if records is not None:
+                conn.close()
+                return records, True
+        except sqlite3.Error:
+            # Corrupt or unreadable cache - drop it and rebuild from the export
+            if conn is not None:
+                conn.close()
+            conn = None
+            try:
+                os.remove(get_index_path(html_file))
+                conn = sqlite3.connect(get_index_path(html_file))
+                read_index(conn, html_file, stat_info)
+            except (OSError, sqlite3.Error):
+                conn = None
+    
+    # Hash and parse in the same pass over the file
+    digest = hashlib.sha256()
+    records = list(iter_memories(html_file, digest=digest))
+    
+    if conn is not None:
+        try:
+            write_index(conn, stat_info, digest.hexdigest(), records)
+        except sqlite3.Error:
+            pass
+        finally:
+            conn.close()
+    return records, False
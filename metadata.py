@@ -4,18 +4,34 @@ Script for extracting GPS coordinates from HTML and writing them to files
 """
 
 import os
-import re
 import json
+import argparse
 import subprocess
-from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from exiftool_pool import ExifToolPool
+from native_metadata import write_native_metadata
+from memories_parser import load_memories, get_index_path, check_integrity, print_integrity_report
 
 # Configuration
 HTML_FILE = 'memories_history.html'
 DOWNLOADED_FILES_JSON = 'downloaded_files.json'
 METADATA_JSON = 'metadata.json'
+STATE_FILE = 'metadata_state.json'  # What was written to which file, so reruns skip it
+STATE_VERSION = 1  # Bump when the written tags change to re-tag everything once
 DOWNLOAD_FOLDER = 'snapchat_memories'
 USE_EXIFTOOL = True
+USE_NATIVE_METADATA = True  # Write JPEG GPS in-process, exiftool only for other formats
+DEFAULT_JOBS = os.cpu_count() or 1  # Files tagged concurrently (one exiftool process each)
+
+parser = argparse.ArgumentParser(description='Write GPS coordinates from memories_history.html to the downloaded files')
+parser.add_argument(
+    '--jobs',
+    type=int,
+    default=DEFAULT_JOBS,
+    help=f'Files to tag concurrently (default: {DEFAULT_JOBS})'
+)
+args = parser.parse_args()
 
 def check_exiftool():
     """Checks if exiftool is installed"""
@@ -27,75 +43,24 @@ def check_exiftool():
 
 exiftool_available = check_exiftool() if USE_EXIFTOOL else False
 
-def extract_locations_from_html(html_file):
-    """Extracts GPS coordinates from the HTML table"""
+# Long-lived exiftool processes - Perl starts once per job, not once per file
+exiftool_pool = ExifToolPool(size=args.jobs)
+can_write_metadata = exiftool_available or USE_NATIVE_METADATA
+
+def extract_memories_from_html(html_file):
+    """Extracts one record per table row (URL, date and GPS joined per row)"""
     if not os.path.exists(html_file):
         print(f"❌ '{html_file}' not found!")
         return []
     
-    with open(html_file, 'r', encoding='utf-8') as f:
-        html_content = f.read()
-    
-    soup = BeautifulSoup(html_content, 'html.parser')
-    locations = []
-    
-    # Search for all tables
-    table = soup.select_one('body > div.rightpanel > table > tbody')
-    if not table:
-        print("⚠️  Table not found in HTML!")
-        return locations
-    
-    rows = table.find_all('tr')
-    
-    # Pattern for coordinates: "Latitude, Longitude: 48.26275, 13.296288"
-    coord_pattern = re.compile(r'Latitude,\s*Longitude:\s*([+-]?\d+\.?\d*),\s*([+-]?\d+\.?\d*)')
-    
-    for row in rows:
-        cells = row.find_all('td')
-        
-        # Search all cells for coordinates
-        for cell in cells:
-            text = cell.get_text(strip=True)
-            match = coord_pattern.search(text)
-            
-            if match:
-                latitude = float(match.group(1))
-                longitude = float(match.group(2))
-                locations.append({
-                    'latitude': latitude,
-                    'longitude': longitude
-                })
-                break  # Only one location per row
-    
-    return locations
-
-def extract_urls_from_html(html_file):
-    """Extracts URLs and creates mapping to index"""
-    if not os.path.exists(html_file):
-        return []
-    
-    with open(html_file, 'r', encoding='utf-8') as f:
-        html_content = f.read()
-    
-    pattern = r"downloadMemories\('(.+?)',\s*this,\s*(true|false)\)"
-    matches = re.findall(pattern, html_content)
-    
-    return [url for url, _ in matches]
-
-def extract_unique_id_from_url(url):
-    """Extracts the unique ID (mid) from the URL"""
-    mid_match = re.search(r'mid=([a-zA-Z0-9\-]+)', url)
-    if mid_match:
-        return mid_match.group(1)
-    else:
-        import hashlib
-        return hashlib.md5(url.encode()).hexdigest()
+    memories, from_cache = load_memories(html_file)
+    if from_cache:
+        print(f"⚡ Export unchanged - loaded from '{get_index_path(html_file)}'")
+    print_integrity_report(check_integrity(memories))
+    return [memory for memory in memories if memory.url]
 
 def write_gps_to_file(filepath, latitude, longitude):
     """Writes GPS coordinates to the EXIF data of the file and preserves timestamps"""
-    if not exiftool_available:
-        return False
-    
     if not os.path.exists(filepath):
         return False
     
@@ -123,9 +88,17 @@ def write_gps_to_file(filepath, latitude, longitude):
         
         result = None
         
-        if file_ext in ['.jpg', '.jpeg', '.png']:
-            result = subprocess.run([
-                'exiftool',
+        # JPEGs are patched in-process, exiftool only handles what that cannot
+        written = USE_NATIVE_METADATA and write_native_metadata(
+            filepath, location={'latitude': latitude, 'longitude': longitude}
+        )
+        
+        if written:
+            pass
+        elif not exiftool_available:
+            return False
+        elif file_ext in ['.jpg', '.jpeg', '.png']:
+            result = exiftool_pool.execute(
                 '-overwrite_original',
                 '-q',
                 f'-GPSLatitude={abs_lat}',
@@ -133,11 +106,10 @@ def write_gps_to_file(filepath, latitude, longitude):
                 f'-GPSLongitude={abs_lon}',
                 f'-GPSLongitudeRef={lon_ref}',
                 filepath
-            ], capture_output=True)
+            )
             
         elif file_ext in ['.mp4', '.mov', '.avi']:
-            result = subprocess.run([
-                'exiftool',
+            result = exiftool_pool.execute(
                 '-overwrite_original',
                 '-q',
                 f'-GPSLatitude={abs_lat}',
@@ -145,10 +117,10 @@ def write_gps_to_file(filepath, latitude, longitude):
                 f'-GPSLongitude={abs_lon}',
                 f'-GPSLongitudeRef={lon_ref}',
                 filepath
-            ], capture_output=True)
+            )
         
-        if result and result.returncode == 0:
-            # Restore the original timestamps after exiftool modifies the file
+        if written or (result and result.returncode == 0):
+            # Restore the original timestamps after the file was modified
             os.utime(filepath, (original_atime, original_mtime))
             
             # On macOS, also restore birth time (creation date) using SetFile command
@@ -189,6 +161,72 @@ def process_files_in_folder(folder_path, latitude, longitude):
     
     return success_count
 
+def get_entry_path(filename):
+    """Path of a downloaded file or of its unpacked ZIP folder (None if neither exists)"""
+    filepath = os.path.join(DOWNLOAD_FOLDER, filename)
+    
+    # Check if it's a file or folder (unpacked ZIP)
+    if os.path.isfile(filepath):
+        return filepath
+    folder_path = filepath.replace('.zip', '')
+    if os.path.isdir(folder_path):
+        return folder_path
+    return None
+
+def get_signature(path):
+    """[size, mtime_ns] of a file - for a folder the total size and newest mtime of its files"""
+    if os.path.isfile(path):
+        stat_info = os.stat(path)
+        return [stat_info.st_size, stat_info.st_mtime_ns]
+    
+    total_size = 0
+    newest_mtime = 0
+    for root, dirs, files in os.walk(path):
+        for file in files:
+            stat_info = os.stat(os.path.join(root, file))
+            total_size += stat_info.st_size
+            newest_mtime = max(newest_mtime, stat_info.st_mtime_ns)
+    return [total_size, newest_mtime]
+
+def is_already_tagged(state_entry, path, location):
+    """True if an earlier run wrote this location and the file has not changed since"""
+    if not state_entry or state_entry.get('version') != STATE_VERSION:
+        return False
+    if 'gps' not in state_entry.get('tags', []) or state_entry.get('location') != location:
+        return False
+    try:
+        return state_entry.get('signature') == get_signature(path)
+    except OSError:
+        return False
+
+def load_json(path):
+    """Loads a JSON object, empty if the file is missing or unreadable"""
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}
+    except (OSError, ValueError):
+        print(f"⚠️  '{path}' could not be read - starting fresh")
+        return {}
+
+def save_json(path, data):
+    """Writes a JSON file atomically, so an interrupted run never leaves it half-written"""
+    tmp_file = path + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_file, path)
+
+def write_gps_for_entry(path, location):
+    """
+    Writes GPS to a downloaded file or unpacked ZIP folder (runs in a worker thread)
+    Returns ('file', written 0/1) or ('folder', files written)
+    """
+    if os.path.isfile(path):
+        return 'file', int(write_gps_to_file(path, location['latitude'], location['longitude']))
+    return 'folder', process_files_in_folder(path, location['latitude'], location['longitude'])
+
 def main():
     print("=" * 60)
     print("📍 Location Metadata Extractor & Writer")
@@ -199,7 +237,10 @@ def main():
     if USE_EXIFTOOL and not exiftool_available:
         print("❌ exiftool not found!")
         print("Installation: https://exiftool.org/")
-        print("Metadata will only be saved in JSON, not in files.")
+        if USE_NATIVE_METADATA:
+            print("GPS will only be written to JPEG files, other formats are saved in JSON only.")
+        else:
+            print("Metadata will only be saved in JSON, not in files.")
         response = input("\nContinue anyway? (y/n): ")
         if response.lower() not in ['y', 'yes']:
             return
@@ -218,111 +259,161 @@ def main():
     
     print(f"📄 {len(downloaded_files)} entries found in downloaded_files.json")
     
-    # Extract locations from HTML
+    # Extract URLs and locations from HTML in a single pass
     print(f"📍 Extracting GPS coordinates from '{HTML_FILE}'...")
-    locations = extract_locations_from_html(HTML_FILE)
-    print(f"✅ {len(locations)} GPS coordinates found")
-    
-    # Extract URLs for mapping
-    urls = extract_urls_from_html(HTML_FILE)
-    print(f"✅ {len(urls)} URLs found")
+    memories = extract_memories_from_html(HTML_FILE)
+    print(f"✅ {sum(1 for m in memories if m.location)} GPS coordinates found")
+    print(f"✅ {len(memories)} URLs found")
     print()
     
-    # Create metadata
-    metadata = {}
+    # Update metadata.json and the tagging state from earlier runs instead of starting over
+    metadata = load_json(METADATA_JSON)
+    previous_metadata = json.loads(json.dumps(metadata))
+    state = load_json(STATE_FILE)
+    processed_count = 0
     files_with_location = 0
     files_without_location = 0
     gps_written_count = 0
     gps_failed_count = 0
+    gps_at_download_count = 0
+    gps_unchanged_count = 0
     gps_errors = []  # Track detailed error information
     
-    total_urls = len(urls)
-    print(f"🔄 Processing {total_urls} URLs...")
+    total_urls = len(memories)
+    jobs = max(1, args.jobs)
+    print(f"🔄 Processing {total_urls} URLs ({jobs} parallel jobs)...")
     print()
     
-    for i, url in enumerate(urls, 1):
-        unique_id = extract_unique_id_from_url(url)
-        
-        # Check if file was downloaded
-        if unique_id not in downloaded_files:
-            print(f"[{i}/{total_urls}] ⏭️  Skipped (not downloaded)")
-            continue
-        
-        file_info = downloaded_files[unique_id]
-        filename = file_info.get('filename')
-        
-        # Add GPS coordinates (if available)
-        location = locations[i-1] if i-1 < len(locations) else None
-        
-        metadata[unique_id] = {
-            'filename': filename,
-            'date': file_info.get('date'),
-            'content_type': file_info.get('content_type'),
-            'location': location
-        }
-        
-        if location:
-            files_with_location += 1
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            # Queue all file writes first, then report them in export order as they finish
+            entries = []
+            queued_ids = set()
+            for i, memory in enumerate(memories, 1):
+                unique_id = memory.unique_id
+                
+                # A memory listed twice would otherwise be written by two workers at once
+                if unique_id in queued_ids:
+                    entries.append((i, None, unique_id, None, 'listed twice'))
+                    continue
+                queued_ids.add(unique_id)
+                
+                # Check if file was downloaded
+                if unique_id not in downloaded_files:
+                    entries.append((i, None, unique_id, None, 'not downloaded'))
+                    continue
+                
+                file_info = downloaded_files[unique_id]
+                filename = file_info.get('filename')
+                
+                # Add GPS coordinates (if available)
+                location = memory.location
+                
+                metadata[unique_id] = {
+                    'filename': filename,
+                    'date': file_info.get('date'),
+                    'content_type': file_info.get('content_type'),
+                    'location': location
+                }
+                
+                # Write GPS to file (unless the downloader or an earlier run already did)
+                path = get_entry_path(filename) if filename else None
+                future = None
+                if (location and path and not file_info.get('gps_written') and can_write_metadata
+                        and not is_already_tagged(state.get(unique_id), path, location)):
+                    future = executor.submit(write_gps_for_entry, path, location)
+                entries.append((i, file_info, unique_id, location, (path, future)))
             
-            # Write GPS to file
-            if exiftool_available:
-                filepath = os.path.join(DOWNLOAD_FOLDER, filename)
+            for i, file_info, unique_id, location, task in entries:
+                if file_info is None:
+                    print(f"[{i}/{total_urls}] ⏭️  Skipped ({task})")
+                    continue
+                
+                processed_count += 1
+                path, future = task
+                filename = file_info.get('filename')
+                if not location:
+                    files_without_location += 1
+                    print(f"[{i}/{total_urls}] 📄 {filename} - No GPS data")
+                    continue
                 
-                # Check if it's a file or folder (unpacked ZIP)
-                if os.path.isfile(filepath):
-                    if write_gps_to_file(filepath, location['latitude'], location['longitude']):
-                        gps_written_count += 1
-                        print(f"[{i}/{total_urls}] ✅ {filename} - GPS written")
-                    else:
-                        gps_failed_count += 1
-                        gps_errors.append({
-                            'filename': filename,
-                            'unique_id': unique_id,
-                            'latitude': location['latitude'],
-                            'longitude': location['longitude']
-                        })
-                        print(f"[{i}/{total_urls}] ⚠️  {filename} - GPS write failed")
+                files_with_location += 1
+                if file_info.get('gps_written'):
+                    gps_at_download_count += 1
+                    print(f"[{i}/{total_urls}] ✅ {filename} - GPS already written at download")
+                    continue
+                if not can_write_metadata:
+                    print(f"[{i}/{total_urls}] 📄 {filename} - Processed (no exiftool)")
+                    continue
+                if path is None:
+                    print(f"[{i}/{total_urls}] 📄 {filename} - Processed (file not found)")
+                    continue
+                if future is None:
+                    gps_unchanged_count += 1
+                    print(f"[{i}/{total_urls}] ⏭️  {filename} - GPS already written (unchanged)")
+                    continue
                 
-                elif os.path.isdir(filepath.replace('.zip', '')):
-                    # Unpacked ZIP folder
-                    folder_path = filepath.replace('.zip', '')
-                    count = process_files_in_folder(folder_path, location['latitude'], location['longitude'])
+                kind, count = future.result()
+                if count:
+                    try:
+                        state[unique_id] = {
+                            'signature': get_signature(path),
+                            'location': location,
+                            'tags': ['gps'],
+                            'version': STATE_VERSION
+                        }
+                    except OSError:
+                        state.pop(unique_id, None)
+                if kind == 'file' and count:
+                    gps_written_count += 1
+                    print(f"[{i}/{total_urls}] ✅ {filename} - GPS written")
+                elif kind == 'file':
+                    gps_failed_count += 1
+                    gps_errors.append({
+                        'filename': filename,
+                        'unique_id': unique_id,
+                        'latitude': location['latitude'],
+                        'longitude': location['longitude']
+                    })
+                    print(f"[{i}/{total_urls}] ⚠️  {filename} - GPS write failed")
+                else:
                     gps_written_count += count
                     print(f"[{i}/{total_urls}] ✅ {filename} - GPS written to {count} files in folder")
-                else:
-                    print(f"[{i}/{total_urls}] 📄 {filename} - Processed (file not found)")
-            else:
-                print(f"[{i}/{total_urls}] 📄 {filename} - Processed (no exiftool)")
-        else:
-            files_without_location += 1
-            print(f"[{i}/{total_urls}] 📄 {filename} - No GPS data")
+    finally:
+        # Keep what was tagged so far, even if the run is interrupted
+        save_json(STATE_FILE, state)
     
     # Save metadata.json
     print()
     print("🔄 Generating final report...")
     print()
-    print(f"💾 Saving '{METADATA_JSON}'...")
-    
-    with open(METADATA_JSON, 'w', encoding='utf-8') as f:
-        json.dump(metadata, f, indent=2, ensure_ascii=False)
+    if metadata != previous_metadata:
+        print(f"💾 Saving '{METADATA_JSON}'...")
+        save_json(METADATA_JSON, metadata)
+    else:
+        print(f"💾 '{METADATA_JSON}' is up to date")
     
     # Summary
     print()
     print("=" * 60)
     print("📊 SUMMARY")
     print("=" * 60)
-    print(f"Total processed: {len(metadata)} files")
+    print(f"Total processed: {processed_count} files")
     print(f"📍 With GPS coordinates: {files_with_location} files")
     print(f"❌ Without GPS coordinates: {files_without_location} files")
     
-    if exiftool_available:
+    if can_write_metadata:
         print()
         print(f"✅ GPS written to files: {gps_written_count}")
+        if gps_at_download_count > 0:
+            print(f"⏭️  Already written at download: {gps_at_download_count}")
+        if gps_unchanged_count > 0:
+            print(f"⏭️  Already written by an earlier run: {gps_unchanged_count}")
         if gps_failed_count > 0:
             print(f"⚠️  GPS write errors: {gps_failed_count}")
     
     print()
-    print(f"✅ '{METADATA_JSON}' successfully created!")
+    print(f"✅ '{METADATA_JSON}' is up to date!")
     
     # Print detailed error list if there were GPS errors
     if gps_failed_count > 0 and gps_errors:
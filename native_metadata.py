@@ -0,0 +1,349 @@
+"""
+In-process metadata writer for the common cases - no exiftool process needed
+JPEG: DateTimeOriginal/CreateDate/ModifyDate and GPS in the EXIF segment
+MP4/MOV: creation/modification times in the mvhd, tkhd and mdhd atoms, patched in place
+Everything else returns False so callers can fall back to exiftool
+"""
+
+import os
+import struct
+import shutil
+from datetime import datetime
+
+# EXIF tags written by snapchat-downloader.py and metadata.py
+TAG_MODIFY_DATE = 0x0132  # IFD0
+TAG_EXIF_IFD = 0x8769  # IFD0 -> Exif IFD pointer
+TAG_GPS_IFD = 0x8825  # IFD0 -> GPS IFD pointer
+TAG_EXIF_VERSION = 0x9000
+TAG_DATE_TIME_ORIGINAL = 0x9003
+TAG_CREATE_DATE = 0x9004
+TAG_GPS_VERSION = 0x0000
+TAG_GPS_LATITUDE_REF = 0x0001
+TAG_GPS_LATITUDE = 0x0002
+TAG_GPS_LONGITUDE_REF = 0x0003
+TAG_GPS_LONGITUDE = 0x0004
+
+TYPE_BYTE = 1
+TYPE_ASCII = 2
+TYPE_LONG = 4
+TYPE_RATIONAL = 5
+TYPE_UNDEFINED = 7
+TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8}
+
+# IFD0 tags that point at data we cannot relocate safely (MakerNote lives in the Exif IFD)
+UNMOVABLE_TAGS = {0x0111, 0x0201, 0x927c, 0xa005, 0x014a}
+
+EXIF_HEADER = b'Exif\x00\x00'
+MP4_EPOCH = datetime(1904, 1, 1)
+MP4_EXTENSIONS = ('.mp4', '.mov')
+JPEG_EXTENSIONS = ('.jpg', '.jpeg')
+
+# ==============================================================================
+# JPEG / EXIF
+# ==============================================================================
+
+def find_exif_segment(f):
+    """
+    Walks the JPEG markers up to the image data
+    Returns (offset of the EXIF payload or None, its length, offset to insert a new APP1 at)
+    """
+    f.seek(0)
+    if f.read(2) != b'\xff\xd8':
+        return None, 0, None
+    
+    insert_at = 2
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xff:
+            return None, 0, insert_at
+        if marker[1] in (0xda, 0xd9):  # Start of scan / end of image
+            return None, 0, insert_at
+        length = struct.unpack('>H', f.read(2))[0]
+        payload_start = f.tell()
+        if marker[1] == 0xe1 and f.read(6) == EXIF_HEADER:
+            return payload_start + 6, length - 8, insert_at
+        if marker[1] == 0xe0 and insert_at == payload_start - 4:
+            # Keep the JFIF APP0 segment first, as exiftool does
+            insert_at = payload_start + length - 2
+        f.seek(payload_start + length - 2)
+
+def read_ifd(tiff, offset, order):
+    """Returns ({tag: (type, count, raw value, value offset)}, next IFD offset)"""
+    count = struct.unpack(order + 'H', tiff[offset:offset + 2])[0]
+    entries = {}
+    for i in range(count):
+        entry = offset + 2 + i * 12
+        tag, value_type, value_count = struct.unpack(order + 'HHI', tiff[entry:entry + 8])
+        size = TYPE_SIZES.get(value_type, 1) * value_count
+        if size <= 4:
+            value_offset = entry + 8
+        else:
+            value_offset = struct.unpack(order + 'I', tiff[entry + 8:entry + 12])[0]
+        entries[tag] = (value_type, value_count, tiff[value_offset:value_offset + size], value_offset)
+    next_offset = struct.unpack(order + 'I', tiff[offset + 2 + count * 12:offset + 6 + count * 12])[0]
+    return entries, next_offset
+
+def read_exif(tiff):
+    """
+    Parses IFD0, Exif IFD and GPS IFD of a TIFF structure
+    Returns (byte order, {ifd name: entries}, whether it can be rebuilt from scratch)
+    """
+    order = '<' if tiff[:2] == b'II' else '>'
+    ifd0_offset = struct.unpack(order + 'I', tiff[4:8])[0]
+    ifd0, next_offset = read_ifd(tiff, ifd0_offset, order)
+    ifds = {'ifd0': ifd0, 'exif': {}, 'gps': {}}
+    if TAG_EXIF_IFD in ifd0:
+        ifds['exif'], _ = read_ifd(tiff, struct.unpack(order + 'I', ifd0[TAG_EXIF_IFD][2])[0], order)
+    if TAG_GPS_IFD in ifd0:
+        ifds['gps'], _ = read_ifd(tiff, struct.unpack(order + 'I', ifd0[TAG_GPS_IFD][2])[0], order)
+    
+    # Thumbnails (IFD1), maker notes and strip offsets hold absolute offsets we would break
+    rebuildable = next_offset == 0 and not any(
+        tag in UNMOVABLE_TAGS for entries in ifds.values() for tag in entries
+    )
+    return order, ifds, rebuildable
+
+def build_ifd(entries, start, order):
+    """Serialises one IFD (entries sorted by tag) with its out-of-line values after it"""
+    count = len(entries)
+    data_offset = start + 2 + count * 12 + 4
+    table = struct.pack(order + 'H', count)
+    data = b''
+    for tag in sorted(entries):
+        value_type, value_count, raw = entries[tag][:3]
+        if len(raw) <= 4:
+            table += struct.pack(order + 'HHI', tag, value_type, value_count) + raw.ljust(4, b'\x00')
+        else:
+            table += struct.pack(order + 'HHII', tag, value_type, value_count, data_offset + len(data))
+            data += raw + (b'\x00' if len(raw) % 2 else b'')
+    return table + struct.pack(order + 'I', 0) + data
+
+def ifd_size(entries):
+    return 2 + len(entries) * 12 + 4 + sum(
+        len(e[2]) + len(e[2]) % 2 for e in entries.values() if len(e[2]) > 4
+    )
+
+def build_exif(ifds, order):
+    """Serialises IFD0, Exif IFD and GPS IFD into a fresh TIFF structure"""
+    ifd0 = dict(ifds['ifd0'])
+    ifd0.pop(TAG_EXIF_IFD, None)
+    ifd0.pop(TAG_GPS_IFD, None)
+    # Pointers are fixed-size, so offsets can be computed before the values are known
+    if ifds['exif']:
+        ifd0[TAG_EXIF_IFD] = (TYPE_LONG, 1, b'\x00' * 4)
+    if ifds['gps']:
+        ifd0[TAG_GPS_IFD] = (TYPE_LONG, 1, b'\x00' * 4)
+    
+    exif_offset = 8 + ifd_size(ifd0)
+    gps_offset = exif_offset + (ifd_size(ifds['exif']) if ifds['exif'] else 0)
+    if ifds['exif']:
+        ifd0[TAG_EXIF_IFD] = (TYPE_LONG, 1, struct.pack(order + 'I', exif_offset))
+    if ifds['gps']:
+        ifd0[TAG_GPS_IFD] = (TYPE_LONG, 1, struct.pack(order + 'I', gps_offset))
+    
+    header = (b'II' if order == '<' else b'MM') + struct.pack(order + 'HI', 42, 8)
+    tiff = header + build_ifd(ifd0, 8, order)
+    if ifds['exif']:
+        tiff += build_ifd(ifds['exif'], exif_offset, order)
+    if ifds['gps']:
+        tiff += build_ifd(ifds['gps'], gps_offset, order)
+    return tiff
+
+def encode_rationals(values, order):
+    return b''.join(struct.pack(order + 'II', numerator, denominator) for numerator, denominator in values)
+
+def to_dms_rationals(value):
+    """Decimal degrees -> degrees, minutes, seconds as EXIF rationals"""
+    value = abs(value)
+    degrees = int(value)
+    minutes = int((value - degrees) * 60)
+    seconds = (value - degrees - minutes / 60) * 3600
+    return [(degrees, 1), (minutes, 1), (int(round(seconds * 10000)), 10000)]
+
+def build_jpeg_tags(dt, location, order):
+    """The tags to write as {ifd name: {tag: (type, count, raw)}}"""
+    tags = {'ifd0': {}, 'exif': {}, 'gps': {}}
+    if dt:
+        date = dt.strftime('%Y:%m:%d %H:%M:%S').encode() + b'\x00'
+        tags['ifd0'][TAG_MODIFY_DATE] = (TYPE_ASCII, 20, date)
+        tags['exif'][TAG_DATE_TIME_ORIGINAL] = (TYPE_ASCII, 20, date)
+        tags['exif'][TAG_CREATE_DATE] = (TYPE_ASCII, 20, date)
+    if location:
+        latitude = location['latitude']
+        longitude = location['longitude']
+        tags['gps'][TAG_GPS_LATITUDE_REF] = (TYPE_ASCII, 2, b'N\x00' if latitude >= 0 else b'S\x00')
+        tags['gps'][TAG_GPS_LATITUDE] = (TYPE_RATIONAL, 3, encode_rationals(to_dms_rationals(latitude), order))
+        tags['gps'][TAG_GPS_LONGITUDE_REF] = (TYPE_ASCII, 2, b'E\x00' if longitude >= 0 else b'W\x00')
+        tags['gps'][TAG_GPS_LONGITUDE] = (TYPE_RATIONAL, 3, encode_rationals(to_dms_rationals(longitude), order))
+    return tags
+
+def write_jpeg_tags(filepath, dt=None, location=None):
+    """
+    Writes date and/or GPS tags into a JPEG
+    Existing tags of the same size are patched in place. Otherwise the EXIF segment is
+    rebuilt, unless it holds data with absolute offsets (thumbnail, maker notes) - then
+    False is returned and exiftool has to do it
+    """
+    with open(filepath, 'r+b') as f:
+        exif_offset, exif_length, insert_at = find_exif_segment(f)
+        if insert_at is None:
+            return False
+        
+        if exif_offset is not None:
+            f.seek(exif_offset)
+            tiff = f.read(exif_length)
+            order, ifds, rebuildable = read_exif(tiff)
+            wanted = build_jpeg_tags(dt, location, order)
+            
+            # Fast path: every tag already exists with the same type and size
+            patches = []
+            for name, tags in wanted.items():
+                for tag, (value_type, value_count, raw) in tags.items():
+                    existing = ifds[name].get(tag)
+                    if not existing or existing[:2] != (value_type, value_count):
+                        break
+                    patches.append((exif_offset + existing[3], raw))
+                else:
+                    continue
+                break
+            else:
+                for offset, raw in patches:
+                    f.seek(offset)
+                    f.write(raw)
+                return True
+            
+            if not rebuildable:
+                return False
+            segment_end = exif_offset + exif_length
+            segment_start = exif_offset - 10
+        else:
+            order = '>'
+            ifds = {'ifd0': {}, 'exif': {}, 'gps': {}}
+            wanted = build_jpeg_tags(dt, location, order)
+            segment_start = segment_end = insert_at
+        
+        for name, tags in wanted.items():
+            ifds[name].update(tags)
+        if ifds['exif'] and TAG_EXIF_VERSION not in ifds['exif']:
+            ifds['exif'][TAG_EXIF_VERSION] = (TYPE_UNDEFINED, 4, b'0232')
+        if ifds['gps'] and TAG_GPS_VERSION not in ifds['gps']:
+            ifds['gps'][TAG_GPS_VERSION] = (TYPE_BYTE, 4, b'\x02\x03\x00\x00')
+        
+        payload = EXIF_HEADER + build_exif(ifds, order)
+        if len(payload) + 2 > 0xffff:
+            return False
+        segment = b'\xff\xe1' + struct.pack('>H', len(payload) + 2) + payload
+        
+        # Swap the segment via a temp file next to the original
+        tmp_path = filepath + '.tmp'
+        with open(tmp_path, 'wb') as out:
+            f.seek(0)
+            out.write(f.read(segment_start))
+            out.write(segment)
+            f.seek(segment_end)
+            shutil.copyfileobj(f, out, 1024 * 1024)
+    os.replace(tmp_path, filepath)
+    return True
+
+# ==============================================================================
+# MP4 / QUICKTIME
+# ==============================================================================
+
+def iter_boxes(f, start, end):
+    """Yields (type, offset, header size, box size) for the boxes between start and end"""
+    position = start
+    while position + 8 <= end:
+        f.seek(position)
+        size, box_type = struct.unpack('>I4s', f.read(8))
+        header = 8
+        if size == 1:
+            size = struct.unpack('>Q', f.read(8))[0]
+            header = 16
+        elif size == 0:
+            size = end - position
+        if size < header:
+            return
+        yield box_type, position, header, size
+        position += size
+
+def find_box(f, start, end, box_type):
+    for found_type, offset, header, size in iter_boxes(f, start, end):
+        if found_type == box_type:
+            return offset, header, size
+    return None
+
+def patch_box_times(f, offset, header, seconds, modification=True):
+    """Sets creation (and modification) time in a mvhd/tkhd/mdhd full box"""
+    f.seek(offset + header)
+    version = f.read(1)[0]
+    f.seek(offset + header + 4)
+    if version == 1:
+        values = (seconds, seconds) if modification else (seconds,)
+        f.write(struct.pack('>' + 'Q' * len(values), *values))
+    else:
+        if seconds > 0xffffffff:
+            return False
+        values = (seconds, seconds) if modification else (seconds,)
+        f.write(struct.pack('>' + 'I' * len(values), *values))
+    return True
+
+def write_mp4_dates(filepath, dt):
+    """
+    Writes CreateDate/ModifyDate (mvhd), TrackCreateDate (tkhd) and MediaCreateDate (mdhd)
+    Only the fixed-size time fields are rewritten - no copy of the file
+    Times are stored as given (like exiftool without the QuickTimeUTC option)
+    """
+    seconds = int((dt - MP4_EPOCH).total_seconds())
+    if seconds < 0:
+        return False
+    
+    with open(filepath, 'r+b') as f:
+        f.seek(0, os.SEEK_END)
+        moov = find_box(f, 0, f.tell(), b'moov')
+        if not moov:
+            return False
+        moov_start = moov[0] + moov[1]
+        moov_end = moov[0] + moov[2]
+        
+        # Locate everything first, so a malformed file is left untouched
+        patches = []
+        mvhd = find_box(f, moov_start, moov_end, b'mvhd')
+        if not mvhd:
+            return False
+        patches.append((mvhd, True))
+        for box_type, offset, header, size in list(iter_boxes(f, moov_start, moov_end)):
+            if box_type != b'trak':
+                continue
+            tkhd = find_box(f, offset + header, offset + size, b'tkhd')
+            if tkhd:
+                patches.append((tkhd, False))
+            mdia = find_box(f, offset + header, offset + size, b'mdia')
+            if mdia:
+                mdhd = find_box(f, mdia[0] + mdia[1], mdia[0] + mdia[2], b'mdhd')
+                if mdhd:
+                    patches.append((mdhd, False))
+        
+        for (offset, header, _), modification in patches:
+            if not patch_box_times(f, offset, header, seconds, modification):
+                return False
+    return True
+
+# ==============================================================================
+# DISPATCH
+# ==============================================================================
+
+def write_native_metadata(filepath, dt=None, location=None):
+    """
+    Writes date and/or GPS without exiftool where this module supports it
+    Returns False (and leaves the file alone) when exiftool is needed instead
+    """
+    file_ext = os.path.splitext(filepath)[1].lower()
+    try:
+        if file_ext in JPEG_EXTENSIONS:
+            return write_jpeg_tags(filepath, dt, location)
+        if file_ext in MP4_EXTENSIONS and dt and not location:
+            # GPS in MP4 needs new atoms (and shifted chunk offsets) - leave that to exiftool
+            return write_mp4_dates(filepath, dt)
+    except (OSError, struct.error, IndexError, ValueError):
+        return False
+    return False
@@ -4,18 +4,61 @@ Snapchat Memories Manager - Unified utility for managing Snapchat memories
 Combines deduplication and overlay merging functionality
 """
 
+import io
+import re
 import os
 import sys
+import json
+import math
 import argparse
+import time
+import sqlite3
 import hashlib
+import tempfile
+import contextlib
+import shutil
 import subprocess
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from itertools import combinations
 from pathlib import Path
-from PIL import Image
+from PIL import Image, JpegImagePlugin
 
 # Configuration
 SOURCE_FOLDER = 'snapchat_memories'
 OUTPUT_FOLDER = 'snapchat_memories_combined'
 DEFAULT_JPEG_QUALITY = 100  # Maximum quality - adjust lower (e.g., 85-95) to save disk space
+# How combined JPEGs are written: 'reencode' the whole frame, or 'lossless-region' to keep the
+# original blocks and re-encode only those under the overlay (needs jpegtran with -drop)
+JPEG_MODES = ['reencode', 'lossless-region']
+DEFAULT_JPEG_MODE = 'reencode'
+HASH_CHUNK_SIZE = 1024 * 1024  # Read size for full file hashes
+PARTIAL_HASH_SIZE = 2 * 1024 * 1024  # Bytes hashed at the start and end of a file before a full hash
+KEEP_POLICIES = ['folder-uuid', 'oldest', 'newest', 'shortest-path', 'largest']  # Which copy dedupe keeps
+HASH_CACHE_FILE = 'dedupe_hash_cache.db'  # Hashes from earlier dedupe runs (dry runs included)
+DEFAULT_HASH_JOBS = os.cpu_count() or 1  # Files hashed in parallel by dedupe
+DEFAULT_PERCEPTUAL_THRESHOLD = 6  # Differing bits (of 64) for images to count as near-duplicates
+PERCEPTUAL_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+PERCEPTUAL_THUMBNAIL_SIZE = 16  # Grayscale thumbnail stored with the dHash to confirm matches
+PERCEPTUAL_MAX_THUMBNAIL_DIFF = 0.15  # Mean thumbnail difference of near-duplicates, in units of their contrast
+PERCEPTUAL_MAX_ASPECT_DIFF = 0.02  # Relative aspect ratio difference of near-duplicates
+PERCEPTUAL_MIN_BITS = 8  # dHashes with fewer set (or unset) bits are too uniform to match
+PERCEPTUAL_MIN_CONTRAST = 8  # Thumbnails with a smaller brightness spread are too uniform to match
+DEFAULT_COMBINE_JOBS = os.cpu_count() or 1  # Images combined in parallel (one process each)
+DEFAULT_VIDEO_JOBS = 1  # ffmpeg already uses every core for a single video
+# Encoder profiles for combined videos (threads 0 = let ffmpeg decide)
+VIDEO_PROFILES = {
+    'fast': {'codec': 'libx264', 'preset': 'veryfast', 'crf': 23, 'threads': 0},
+    'balanced': {'codec': 'libx264', 'preset': 'medium', 'crf': 23, 'threads': 0},
+    'quality': {'codec': 'libx264', 'preset': 'slow', 'crf': 18, 'threads': 0},
+    'hevc': {'codec': 'libx265', 'preset': 'medium', 'crf': 26, 'threads': 0, 'extra': ['-tag:v', 'hvc1']},
+}
+DEFAULT_VIDEO_PROFILE = 'balanced'  # Same settings ffmpeg picks by default for MP4
+VIDEO_MAX_BITRATE_FACTOR = 1.5  # Cap the output bitrate at this multiple of the source bitrate
+VIDEO_CRF_OFFSETS = [(480, -2), (720, -1)]  # CRF change for videos up to this short side - artefacts show more
+VIDEO_FALLBACK_BITS_PER_PIXEL = 0.15  # Bitrate cap per pixel and frame (at 30 fps) when the source bitrate is unknown
+BENCHMARK_SAMPLE_VIDEOS = 3  # Videos encoded per profile by combine --benchmark
+COMBINE_STATE_FILE = 'combine_state.json'  # Inputs and settings of every combined output
+COMBINE_STATE_VERSION = 2  # Bump when the compositing changes to rebuild all outputs once
 
 # ==============================================================================
 # DEDUPLICATION FUNCTIONS (from delete-dupes.py)
@@ -24,16 +67,447 @@ DEFAULT_JPEG_QUALITY = 100  # Maximum quality - adjust lower (e.g., 85-95) to sa
 def calculate_file_hash(filepath):
     """Calculate SHA256 hash of a file"""
     sha256_hash = hashlib.sha256()
+    try:
+        # Large unbuffered reads into one reused buffer
+        buffer = bytearray(HASH_CHUNK_SIZE)
+        view = memoryview(buffer)
+        with open(filepath, "rb", buffering=0) as f:
+            while True:
+                size = f.readinto(buffer)
+                if not size:
+                    break
+                sha256_hash.update(view[:size])
+        return sha256_hash.hexdigest()
+    except Exception as e:
+        print(f"❌ Error calculating hash for {filepath}: {e}")
+        return None
+
+def calculate_partial_hash(filepath, file_size):
+    """SHA256 of the first and last PARTIAL_HASH_SIZE bytes of a file"""
+    sha256_hash = hashlib.sha256()
     try:
         with open(filepath, "rb") as f:
-            for byte_block in iter(lambda: f.read(4096), b""):
-                sha256_hash.update(byte_block)
+            sha256_hash.update(f.read(PARTIAL_HASH_SIZE))
+            f.seek(file_size - PARTIAL_HASH_SIZE)
+            sha256_hash.update(f.read(PARTIAL_HASH_SIZE))
         return sha256_hash.hexdigest()
     except Exception as e:
         print(f"❌ Error calculating hash for {filepath}: {e}")
         return None
 
-def find_duplicates_in_folder(folder_path):
+def calculate_perceptual_hash(filepath):
+    """
+    Perceptual fingerprint of an image as 'dhash:thumbnail:WIDTHxHEIGHT'
+    dhash: 64-bit difference hash (16 hex digits) - survives re-encoding and resizing, it
+    only records whether each pixel of a 9x8 grayscale thumbnail is brighter than its right neighbour
+    thumbnail: 16x16 grayscale pixels (hex), compared to confirm a dHash match
+    """
+    try:
+        with Image.open(filepath) as img:
+            width, height = img.size
+            # Let the JPEG decoder downscale while decoding - much faster than a full decode
+            img.draft('L', (64, 64))
+            gray = img.convert('L')
+        pixels = gray.resize((9, 8), Image.Resampling.BOX).tobytes()
+        thumbnail = gray.resize((PERCEPTUAL_THUMBNAIL_SIZE, PERCEPTUAL_THUMBNAIL_SIZE), Image.Resampling.BOX)
+        bits = 0
+        for row in range(8):
+            for col in range(8):
+                bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+        return f'{bits:016x}:{thumbnail.tobytes().hex()}:{width}x{height}'
+    except Exception as e:
+        print(f"❌ Error calculating perceptual hash for {filepath}: {e}")
+        return None
+
+def parse_perceptual_hash(value):
+    """(dHash as int, thumbnail bytes, aspect ratio) from calculate_perceptual_hash's string"""
+    dhash, thumbnail, size = value.split(':')
+    width, height = size.split('x')
+    return int(dhash, 16), bytes.fromhex(thumbnail), int(width) / max(int(height), 1)
+
+def normalize_thumbnail(thumbnail):
+    """Thumbnail pixels as (pixel - mean) / standard deviation, so brightness and contrast shifts cancel out"""
+    mean = sum(thumbnail) / len(thumbnail)
+    spread = math.sqrt(sum((pixel - mean) ** 2 for pixel in thumbnail) / len(thumbnail)) or 1.0
+    return [(pixel - mean) / spread for pixel in thumbnail]
+
+def is_low_information(dhash, thumbnail):
+    """
+    Near-uniform images (black, white or solid-colour frames) all hash to about 0 whatever
+    their colour, and flat dark photos hash to a few scattered bits - they cannot be matched
+    """
+    bit_count = bin(dhash).count('1')
+    if min(bit_count, 64 - bit_count) < PERCEPTUAL_MIN_BITS:
+        return True
+    mean = sum(thumbnail) / len(thumbnail)
+    spread = math.sqrt(sum((pixel - mean) ** 2 for pixel in thumbnail) / len(thumbnail))
+    return spread < PERCEPTUAL_MIN_CONTRAST
+
+def images_look_alike(first, second, threshold):
+    """
+    Both fingerprints (parse_perceptual_hash) match: dHashes within `threshold` bits,
+    the same aspect ratio and thumbnails that differ little pixel by pixel
+    """
+    if bin(first[0] ^ second[0]).count('1') > threshold:
+        return False
+    if abs(first[2] - second[2]) > PERCEPTUAL_MAX_ASPECT_DIFF * max(first[2], second[2]):
+        return False
+    difference = sum(abs(a - b) for a, b in zip(normalize_thumbnail(first[1]), normalize_thumbnail(second[1])))
+    return difference / len(first[1]) <= PERCEPTUAL_MAX_THUMBNAIL_DIFF
+
+class MultiIndexHash:
+    """
+    Index of 64-bit hashes for Hamming radius searches (multi-index hashing)
+    Hashes are split into four 16-bit parts with one lookup table each. Two hashes
+    within `radius` bits differ in at most radius // 4 bits in one of the parts, so a
+    search only looks up each part with up to that many bits flipped - no pairwise scan
+    """
+    
+    PARTS = 4
+    PART_BITS = 16
+    
+    def __init__(self, radius):
+        self.radius = radius
+        self.tables = [{} for _ in range(self.PARTS)]
+        # Every way to flip up to radius // PARTS bits of one part
+        self.flips = [0]
+        for bit_count in range(1, radius // self.PARTS + 1):
+            for bits in combinations(range(self.PART_BITS), bit_count):
+                self.flips.append(sum(1 << bit for bit in bits))
+    
+    def _parts(self, value):
+        mask = (1 << self.PART_BITS) - 1
+        return [(value >> (index * self.PART_BITS)) & mask for index in range(self.PARTS)]
+    
+    def add(self, value, item):
+        for table, part in zip(self.tables, self._parts(value)):
+            table.setdefault(part, []).append((value, item))
+    
+    def search(self, value):
+        """All items whose hash differs from `value` in at most `radius` bits"""
+        seen = set()
+        matches = []
+        for table, part in zip(self.tables, self._parts(value)):
+            for flip in self.flips:
+                for candidate, item in table.get(part ^ flip, ()):
+                    if item not in seen:
+                        seen.add(item)
+                        if bin(candidate ^ value).count('1') <= self.radius:
+                            matches.append(item)
+        return matches
+
+class HashCache:
+    """
+    SQLite cache of partial, full and perceptual hashes keyed by path, inode, size and mtime
+    A file that was replaced or modified no longer matches its entry and is hashed again
+    """
+    
+    def __init__(self, cache_file=HASH_CACHE_FILE):
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(cache_file)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS hashes '
+                          '(path TEXT PRIMARY KEY, inode INTEGER, size INTEGER, mtime_ns INTEGER, '
+                          'partial_hash TEXT, full_hash TEXT, perceptual_hash TEXT)')
+        # Caches created before --perceptual existed lack that column
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(hashes)')]
+        if 'perceptual_hash' not in columns:
+            self.conn.execute('ALTER TABLE hashes ADD COLUMN perceptual_hash TEXT')
+    
+    def get(self, filepath, stat_info, column):
+        """Cached hash ('partial_hash', 'full_hash', 'perceptual_hash'), None if missing or stale"""
+        row = self.conn.execute(f'SELECT inode, size, mtime_ns, {column} FROM hashes WHERE path = ?',
+                                (os.path.abspath(filepath),)).fetchone()
+        if row and row[3] and row[:3] == (stat_info.st_ino, stat_info.st_size, stat_info.st_mtime_ns):
+            self.hits += 1
+            return row[3]
+        self.misses += 1
+        return None
+    
+    def put(self, filepath, stat_info, column, value):
+        key = (os.path.abspath(filepath), stat_info.st_ino, stat_info.st_size, stat_info.st_mtime_ns)
+        # Keep the other hash of an unchanged file, replace the entry of a changed one
+        cursor = self.conn.execute(
+            f'UPDATE hashes SET {column} = ? WHERE path = ? AND inode = ? AND size = ? AND mtime_ns = ?',
+            (value,) + key
+        )
+        if cursor.rowcount == 0:
+            self.conn.execute(
+                f'INSERT OR REPLACE INTO hashes (path, inode, size, mtime_ns, {column}) VALUES (?, ?, ?, ?, ?)',
+                key + (value,)
+            )
+    
+    def evict_missing(self):
+        """Drop entries of files that no longer exist, returns how many were dropped"""
+        missing = [(path,) for (path,) in self.conn.execute('SELECT path FROM hashes')
+                   if not os.path.exists(path)]
+        self.conn.executemany('DELETE FROM hashes WHERE path = ?', missing)
+        return len(missing)
+    
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+class FileHasher:
+    """
+    Hashes files on a thread pool (hashlib releases the GIL while hashing large blocks)
+    Cached hashes are reused, and hashing time and volume are tracked for the summary
+    Memory stays bounded: every job reads through its own HASH_CHUNK_SIZE buffer
+    """
+    
+    def __init__(self, jobs=1, cache=None):
+        self.jobs = max(1, jobs)
+        self.cache = cache
+        self.executor = ThreadPoolExecutor(max_workers=self.jobs) if self.jobs > 1 else None
+        self.files_hashed = 0
+        self.bytes_hashed = 0
+        self.seconds = 0.0
+    
+    def hash_files(self, filepaths, stat_infos, kind='full'):
+        """
+        Hashes as {path: hash} (files that could not be read are left out)
+        kind: 'partial' (start and end), 'full' or 'perceptual' (images only)
+        """
+        column = kind + '_hash'
+        results = {}
+        pending = []
+        for filepath in filepaths:
+            cached_hash = self.cache.get(filepath, stat_infos[filepath], column) if self.cache else None
+            # Perceptual hashes cached before the thumbnail was stored with them are recomputed
+            if cached_hash and (kind != 'perceptual' or ':' in cached_hash):
+                results[filepath] = cached_hash
+            else:
+                pending.append(filepath)
+        
+        if not pending:
+            return results
+        
+        if kind == 'partial':
+            hash_function = lambda filepath: calculate_partial_hash(filepath, stat_infos[filepath].st_size)
+        elif kind == 'perceptual':
+            hash_function = calculate_perceptual_hash
+        else:
+            hash_function = calculate_file_hash
+        
+        start_time = time.time()
+        mapped = self.executor.map(hash_function, pending) if self.executor else map(hash_function, pending)
+        for filepath, file_hash in zip(pending, mapped):
+            if not file_hash:
+                continue
+            results[filepath] = file_hash
+            self.files_hashed += 1
+            self.bytes_hashed += 2 * PARTIAL_HASH_SIZE if kind == 'partial' else stat_infos[filepath].st_size
+            if self.cache is not None:
+                self.cache.put(filepath, stat_infos[filepath], column, file_hash)
+        self.seconds += time.time() - start_time
+        return results
+    
+    def describe(self):
+        """Throughput line for the summary"""
+        megabytes = self.bytes_hashed / (1024 * 1024)
+        seconds = max(self.seconds, 1e-6)
+        return (f"⏱️  Hashed {self.files_hashed} files ({megabytes:.1f} MB) in {self.seconds:.2f}s "
+                f"with {self.jobs} job(s) - {megabytes / seconds:.1f} MB/s, {self.files_hashed / seconds:.1f} files/s")
+    
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+def group_identical_files(filepaths, hasher=None, per_folder=False):
+    """
+    Group byte-identical files as [(hash, [paths])] (only groups with 2+ files)
+    Files are compared by size first, then by a hash of their start and end - only
+    files that still collide are hashed in full. Each stage hashes all its files in one
+    batch, so the hasher can spread them over its jobs
+    With per_folder, only files in the same folder are compared
+    """
+    if hasher is None:
+        hasher = FileHasher()
+    
+    files_by_size = {}
+    stat_infos = {}
+    for filepath in filepaths:
+        try:
+            stat_infos[filepath] = os.stat(filepath)
+        except OSError as e:
+            print(f"❌ Error reading size of {filepath}: {e}")
+            continue
+        folder = os.path.dirname(filepath) if per_folder else None
+        files_by_size.setdefault((folder, stat_infos[filepath].st_size), []).append(filepath)
+    
+    groups = []
+    partial_candidates = []
+    for (folder, file_size), candidates in files_by_size.items():
+        if len(candidates) < 2:
+            continue
+        if file_size <= 2 * PARTIAL_HASH_SIZE:
+            # Start and end would cover the whole file anyway
+            groups.append(candidates)
+        else:
+            partial_candidates.extend(candidates)
+    
+    partial_hashes = hasher.hash_files(partial_candidates, stat_infos, kind='partial')
+    files_by_partial_hash = {}
+    for filepath in partial_candidates:
+        if filepath in partial_hashes:
+            folder = os.path.dirname(filepath) if per_folder else None
+            key = (folder, stat_infos[filepath].st_size, partial_hashes[filepath])
+            files_by_partial_hash.setdefault(key, []).append(filepath)
+    groups.extend(group for group in files_by_partial_hash.values() if len(group) > 1)
+    
+    full_candidates = [filepath for group in groups for filepath in group]
+    full_hashes = hasher.hash_files(full_candidates, stat_infos)
+    file_hashes = {}
+    for filepath in full_candidates:
+        if filepath in full_hashes:
+            folder = os.path.dirname(filepath) if per_folder else None
+            file_hashes.setdefault((folder, full_hashes[filepath]), []).append(filepath)
+    
+    return [(file_hash, paths) for (folder, file_hash), paths in file_hashes.items() if len(paths) > 1]
+
+def find_similar_images(filepaths, threshold, hasher=None, per_folder=False):
+    """
+    Group images that look the same as [(hash, [paths], similar)] - re-encoded or resized copies included
+    Candidates come from a MultiIndexHash of the dHashes. An image only joins a group when it
+    matches every image already in it (dHash, aspect ratio and thumbnail), so a chain of
+    slightly different photos never ends up in one group. Near-uniform images are only
+    grouped with exact copies (similar False)
+    """
+    if hasher is None:
+        hasher = FileHasher()
+    
+    stat_infos = {}
+    for filepath in filepaths:
+        try:
+            stat_infos[filepath] = os.stat(filepath)
+        except OSError as e:
+            print(f"❌ Error reading size of {filepath}: {e}")
+    images = [filepath for filepath in filepaths if filepath in stat_infos]
+    perceptual_hashes = hasher.hash_files(images, stat_infos, kind='perceptual')
+    
+    fingerprints = {}
+    uniform_images = []
+    for filepath in images:
+        if filepath not in perceptual_hashes:
+            continue
+        fingerprint = parse_perceptual_hash(perceptual_hashes[filepath])
+        if is_low_information(fingerprint[0], fingerprint[1]):
+            uniform_images.append(filepath)
+        else:
+            fingerprints[filepath] = fingerprint
+    if uniform_images:
+        print(f"⚠️  {len(uniform_images)} near-uniform image(s) only compared byte for byte by --perceptual")
+    
+    groups = []
+    indexes = {}
+    for filepath, fingerprint in fingerprints.items():
+        index = indexes.setdefault(os.path.dirname(filepath) if per_folder else None, MultiIndexHash(threshold))
+        candidates = sorted(set(index.search(fingerprint[0])))
+        for group_index in candidates:
+            if all(images_look_alike(fingerprint, fingerprints[member], threshold) for member in groups[group_index]):
+                groups[group_index].append(filepath)
+                break
+        else:
+            groups.append([filepath])
+            group_index = len(groups) - 1
+        index.add(fingerprint[0], group_index)
+    
+    similar_groups = [(file_hash, paths, False) for file_hash, paths in
+                      group_identical_files(uniform_images, hasher, per_folder)]
+    for paths in groups:
+        if len(paths) < 2:
+            continue
+        # A group of byte-identical copies is an exact duplicate, not a near-duplicate
+        identical = group_identical_files(paths, hasher)
+        if len(identical) == 1 and len(identical[0][1]) == len(paths):
+            similar_groups.append((identical[0][0], paths, False))
+        else:
+            similar_groups.append((perceptual_hashes[paths[0]].split(':')[0], paths, True))
+    return similar_groups
+
+def group_files(filepaths, hasher=None, per_folder=False, perceptual_threshold=None):
+    """
+    Exact duplicate groups, or with perceptual_threshold near-duplicate groups for images
+    (overlay layers are mostly transparent, so they are only matched exactly)
+    Returns [(hash, [paths], similar)] - similar is True for near-duplicates
+    """
+    if perceptual_threshold is None:
+        return [(file_hash, paths, False) for file_hash, paths in group_identical_files(filepaths, hasher, per_folder)]
+    
+    images = []
+    others = []
+    for filepath in filepaths:
+        filename = os.path.basename(filepath).lower()
+        if filename.endswith(PERCEPTUAL_EXTENSIONS) and '-overlay' not in filename:
+            images.append(filepath)
+        else:
+            others.append(filepath)
+    return ([(file_hash, paths, False) for file_hash, paths in group_identical_files(others, hasher, per_folder)] +
+            find_similar_images(images, perceptual_threshold, hasher, per_folder))
+
+def choose_file_to_keep(filepaths, keep_policy='folder-uuid'):
+    """
+    Split a group of identical files into (file to keep, files to remove)
+    folder-uuid: the file named after its memory folder (format: YYYYMMDD_HHMMSS_UUID)
+    oldest/newest: by modification time, shortest-path: the least nested file,
+    largest: the biggest file (for near-duplicates usually the best quality)
+    """
+    filepaths = sorted(filepaths)
+    primary = None
+    
+    if keep_policy == 'folder-uuid':
+        for filepath in filepaths:
+            folder_name = os.path.basename(os.path.dirname(filepath))
+            # Extract UUID/ID from folder name
+            folder_uuid = folder_name.split('_', 2)[-1] if '_' in folder_name else folder_name
+            # Check if filename starts with folder UUID
+            if os.path.basename(filepath).startswith(folder_uuid):
+                primary = filepath
+                break
+    elif keep_policy in ('oldest', 'newest'):
+        mtimes = {}
+        for filepath in filepaths:
+            try:
+                mtimes[filepath] = os.stat(filepath).st_mtime
+            except OSError:
+                pass
+        if mtimes:
+            sign = 1 if keep_policy == 'oldest' else -1
+            primary = min(mtimes, key=lambda path: (sign * mtimes[path], path))
+    elif keep_policy == 'shortest-path':
+        primary = min(filepaths, key=lambda path: (path.count(os.sep), len(path), path))
+    elif keep_policy == 'largest':
+        sizes = {}
+        for filepath in filepaths:
+            try:
+                sizes[filepath] = os.path.getsize(filepath)
+            except OSError:
+                pass
+        if sizes:
+            primary = min(sizes, key=lambda path: (-sizes[path], path))
+    
+    # No match for the policy - keep the first file
+    if primary is None:
+        primary = filepaths[0]
+    
+    return primary, [filepath for filepath in filepaths if filepath != primary]
+
+def build_duplicate_groups(file_hashes, keep_policy):
+    """Turn [(hash, [paths], similar)] into keep/delete groups"""
+    duplicates = []
+    for file_hash, filepaths, similar in file_hashes:
+        primary, to_delete = choose_file_to_keep(filepaths, keep_policy)
+        if to_delete:
+            duplicates.append({
+                'hash': file_hash,
+                'keep': primary,
+                'delete': to_delete,
+                'similar': similar,
+                'layers': []  # Copies kept because another memory's combine needs them
+            })
+    return duplicates
+
+def find_duplicates_in_folder(folder_path, keep_policy='folder-uuid', hasher=None, perceptual_threshold=None):
     """Find duplicates in a folder based on hash"""
     files = []
     
@@ -45,88 +519,180 @@ def find_duplicates_in_folder(folder_path):
     if len(files) < 2:
         return []
     
-    # Calculate hashes for all files
-    file_hashes = {}
-    for filepath in files:
-        file_hash = calculate_file_hash(filepath)
-        if file_hash:
-            if file_hash not in file_hashes:
-                file_hashes[file_hash] = []
-            file_hashes[file_hash].append(filepath)
-    
-    # Find duplicates (hash with multiple files)
-    duplicates = []
-    for file_hash, filepaths in file_hashes.items():
-        if len(filepaths) > 1:
-            # Sort: Keep the file that matches the folder name
-            folder_name = os.path.basename(folder_path)
-            
-            # Extract UUID/ID from folder name (format: YYYYMMDD_HHMMSS_UUID)
-            folder_uuid = folder_name.split('_', 2)[-1] if '_' in folder_name else folder_name
-            
-            primary = None
-            to_delete = []
-            
-            for filepath in filepaths:
-                filename = os.path.basename(filepath)
-                # Check if filename starts with folder UUID
-                if filename.startswith(folder_uuid):
-                    primary = filepath
-                else:
-                    to_delete.append(filepath)
-            
-            # If no match with folder UUID, keep the first file
-            if primary is None:
-                primary = filepaths[0]
-                to_delete = filepaths[1:]
-            
-            if to_delete:
-                duplicates.append({
-                    'hash': file_hash,
-                    'keep': primary,
-                    'delete': to_delete
-                })
+    # Hash only files that could be identical (same size, same start and end)
+    file_hashes = group_files(files, hasher, perceptual_threshold=perceptual_threshold)
     
-    return duplicates
+    return build_duplicate_groups(file_hashes, keep_policy)
+
+def find_duplicates_per_folder(directory, keep_policy='folder-uuid', hasher=None, perceptual_threshold=None):
+    """
+    Like find_duplicates_in_folder for every subfolder, but hashed in one batch
+    Returns [(folder name, folder path, duplicates)] for folders with duplicates
+    """
+    files = []
+    for item in sorted(os.listdir(directory)):
+        item_path = os.path.join(directory, item)
+        if os.path.isdir(item_path):
+            for filename in os.listdir(item_path):
+                filepath = os.path.join(item_path, filename)
+                if os.path.isfile(filepath):
+                    files.append(filepath)
+    
+    hashes_by_folder = {}
+    for group in group_files(files, hasher, True, perceptual_threshold):
+        hashes_by_folder.setdefault(os.path.dirname(group[1][0]), []).append(group)
+    
+    results = []
+    for item in sorted(os.listdir(directory)):
+        item_path = os.path.join(directory, item)
+        if item_path in hashes_by_folder:
+            duplicates = build_duplicate_groups(hashes_by_folder[item_path], keep_policy)
+            if duplicates:
+                results.append((item, item_path, duplicates))
+    return results
+
+def is_layer_of_other_memory(filepath, keep_path):
+    """
+    Overlay or main layer of a memory folder other than the one of `keep_path`
+    combine reads these by name, so deleting one breaks its memory - only a link may replace it
+    """
+    filename = os.path.basename(filepath).lower()
+    is_layer = '-overlay.png' in filename or '-main.' in filename
+    return is_layer and os.path.dirname(filepath) != os.path.dirname(keep_path)
 
-def process_deduplication(directory, dry_run=True):
-    """Process all folders and find duplicates"""
+def find_duplicates_in_archive(directory, keep_policy='folder-uuid', hasher=None, perceptual_threshold=None):
+    """
+    Find duplicates anywhere below `directory` - top-level files, memory folders and across folders
+    All files go into one content index (size -> start/end hash -> full hash), so a memory
+    exported twice under different IDs is found as well
+    """
+    files = []
+    for root, dirs, filenames in os.walk(directory):
+        dirs.sort()
+        for filename in sorted(filenames):
+            filepath = os.path.join(root, filename)
+            if not os.path.islink(filepath):
+                files.append(filepath)
+    
+    if len(files) < 2:
+        return []
+    
+    return build_duplicate_groups(group_files(files, hasher, perceptual_threshold=perceptual_threshold), keep_policy)
+
+def link_file(source, target, link_mode):
+    """
+    Replace `target` with a hardlink or reflink (copy-on-write clone) of `source`
+    The replacement is created next to the target first, so a failure never loses the file
+    """
+    tmp_path = target + '.dedupe-tmp'
+    if link_mode == 'hardlink':
+        os.link(source, tmp_path)
+    else:
+        stat_info = os.stat(target)
+        # APFS clones on macOS, btrfs/XFS reflinks on Linux
+        clone_flag = '-c' if sys.platform == 'darwin' else '--reflink=always'
+        result = subprocess.run(['cp', clone_flag, source, tmp_path], capture_output=True, text=True)
+        if result.returncode != 0:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise OSError(result.stderr.strip() or 'reflinks are not supported on this file system')
+        # A clone is a new file - keep the dates of the file it replaces
+        os.utime(tmp_path, (stat_info.st_atime, stat_info.st_mtime))
+    os.replace(tmp_path, target)
+
+def process_deduplication(directory, dry_run=True, scope='folder', keep_policy='folder-uuid', link_mode=None,
+                          use_cache=True, jobs=1, perceptual_threshold=None, apply_similar=False):
+    """
+    Process all folders and find duplicates
+    scope 'folder' compares files within each memory folder, 'archive' the whole tree
+    With link_mode ('hardlink'/'reflink') duplicates are replaced by links instead of deleted
+    With perceptual_threshold, images that only look the same are reported too - and only
+    deleted/linked with apply_similar
+    """
     if not os.path.exists(directory):
         print(f"❌ Folder '{directory}' does not exist!")
         return
     
+    cache = None
+    if use_cache:
+        try:
+            cache = HashCache()
+        except sqlite3.Error as e:
+            print(f"⚠️  Hash cache unavailable ({e}) - hashing without it")
+    hasher = FileHasher(jobs, cache)
+    try:
+        process_duplicates(directory, dry_run, scope, keep_policy, link_mode, hasher, perceptual_threshold,
+                           apply_similar)
+    finally:
+        hasher.close()
+        if hasher.files_hashed:
+            print()
+            print(hasher.describe())
+        if cache is not None:
+            try:
+                evicted = cache.evict_missing()
+                print()
+                print(f"⚡ Hash cache: {cache.hits} reused, {cache.misses} computed, {evicted} stale entries removed")
+                cache.close()
+            except sqlite3.Error as e:
+                print(f"⚠️  Could not update hash cache: {e}")
+
+def process_duplicates(directory, dry_run, scope, keep_policy, link_mode, hasher, perceptual_threshold,
+                       apply_similar=False):
+    """Find, report and remove/link the duplicates (see process_deduplication)"""
     folders_with_duplicates = []
     total_duplicates = 0
+    reported_only = 0  # Near-duplicates left alone without apply_similar
+    layers_kept = 0  # Layers of other memories left alone without link_mode
     deleted_count = 0
     deletion_errors = []  # Track errors
     
     print("🔍 Scanning for duplicates...")
     print()
     
-    # Search all subfolders
-    for item in os.listdir(directory):
-        item_path = os.path.join(directory, item)
-        
-        if os.path.isdir(item_path):
-            duplicates = find_duplicates_in_folder(item_path)
-            
-            if duplicates:
-                folders_with_duplicates.append({
-                    'folder': item,
-                    'path': item_path,
-                    'duplicates': duplicates
-                })
-                
-                # Count all files to delete
-                for dup in duplicates:
-                    total_duplicates += len(dup['delete'])
+    if scope == 'archive':
+        # One content index over every file in the tree
+        duplicates = find_duplicates_in_archive(directory, keep_policy, hasher, perceptual_threshold)
+        if not link_mode:
+            for dup in duplicates:
+                dup['layers'] = [filepath for filepath in dup['delete'] if is_layer_of_other_memory(filepath, dup['keep'])]
+                dup['delete'] = [filepath for filepath in dup['delete'] if filepath not in dup['layers']]
+        if duplicates:
+            folders_with_duplicates.append({
+                'folder': os.path.basename(os.path.normpath(directory)),
+                'path': directory,
+                'duplicates': duplicates
+            })
+    else:
+        # Search all subfolders
+        for item, item_path, duplicates in find_duplicates_per_folder(directory, keep_policy, hasher,
+                                                                      perceptual_threshold):
+            folders_with_duplicates.append({
+                'folder': item,
+                'path': item_path,
+                'duplicates': duplicates
+            })
+    
+    # Count all files to delete
+    for folder_info in folders_with_duplicates:
+        for dup in folder_info['duplicates']:
+            if dup['similar'] and not apply_similar:
+                reported_only += len(dup['delete'])
+            else:
+                total_duplicates += len(dup['delete'])
+            layers_kept += len(dup['layers'])
     
     if not folders_with_duplicates:
         print("✅ No duplicates found!")
         return
     
     print(f"📊 {len(folders_with_duplicates)} folders with duplicates found")
-    print(f"🗑️  Total {total_duplicates} duplicates to delete\n")
+    print(f"🗑️  Total {total_duplicates} duplicates to {'replace with ' + link_mode + 's' if link_mode else 'delete'}")
+    if reported_only:
+        print(f"👀 {reported_only} near-duplicates only reported (add --apply-similar to handle them too)")
+    if layers_kept:
+        print(f"🔒 {layers_kept} layers of other memories kept (add --link to link them instead)")
+    print()
     print("=" * 80)
     print()
     
@@ -144,15 +710,31 @@ def process_deduplication(directory, dry_run=True):
         print()
         
         for dup in duplicates:
-            keep_file = os.path.basename(dup['keep'])
+            # Paths relative to the scanned folder (just the filename in folder scope)
+            keep_file = os.path.relpath(dup['keep'], folder_info['path'])
             print(f"            ✅ KEEP:   {keep_file}")
             
             for delete_file in dup['delete']:
-                delete_filename = os.path.basename(delete_file)
-                print(f"            🗑️  DELETE: {delete_filename}")
+                delete_filename = os.path.relpath(delete_file, folder_info['path'])
+                if dup['similar'] and not apply_similar:
+                    print(f"            👀 SIMILAR: {delete_filename}")
+                    continue
+                if link_mode:
+                    print(f"            🔗 LINK:   {delete_filename}")
+                else:
+                    print(f"            🗑️  DELETE: {delete_filename}")
                 
                 if not dry_run:
                     try:
+                        if link_mode:
+                            if os.path.samefile(dup['keep'], delete_file):
+                                deleted_count += 1
+                                print(f"               → Already linked")
+                                continue
+                            link_file(dup['keep'], delete_file, link_mode)
+                            deleted_count += 1
+                            print(f"               → Replaced with {link_mode}!")
+                            continue
                         os.remove(delete_file)
                         deleted_count += 1
                         print(f"               → Deleted!")
@@ -164,6 +746,9 @@ def process_deduplication(directory, dry_run=True):
                             'error': str(e)
                         })
             
+            for layer_file in dup['layers']:
+                print(f"            🔒 KEEP:   {os.path.relpath(layer_file, folder_info['path'])} (layer of another memory)")
+            
             print()
         
         print("-" * 80)
@@ -181,14 +766,28 @@ def process_deduplication(directory, dry_run=True):
         print("⚠️  DRY RUN MODE - No files deleted!")
         print()
         print(f"📊 Folders with duplicates: {len(folders_with_duplicates)}")
-        print(f"🗑️  Files to delete: {total_duplicates}")
+        if link_mode:
+            print(f"🔗 Files to replace with {link_mode}s: {total_duplicates}")
+        else:
+            print(f"🗑️  Files to delete: {total_duplicates}")
+        if reported_only:
+            print(f"👀 Near-duplicates only reported: {reported_only}")
+        if layers_kept:
+            print(f"🔒 Layers of other memories kept: {layers_kept}")
         print()
         print("💡 To actually delete duplicates, rerun with --execute flag:")
         print("   python overlay-manager.py dedupe --execute")
     else:
-        print(f"✅ Successfully deleted: {deleted_count} files")
+        if link_mode:
+            print(f"✅ Successfully replaced with {link_mode}s: {deleted_count} files")
+        else:
+            print(f"✅ Successfully deleted: {deleted_count} files")
         if deleted_count < total_duplicates:
             print(f"⚠️  Errors with: {total_duplicates - deleted_count} files")
+        if reported_only:
+            print(f"👀 Near-duplicates left alone: {reported_only} (add --apply-similar to handle them too)")
+        if layers_kept:
+            print(f"🔒 Layers of other memories kept: {layers_kept} (add --link to link them instead)")
         
         # Print detailed error list if there were errors
         if deletion_errors:
@@ -228,7 +827,7 @@ def find_overlay_folders(directory):
     
     print("🔍 Scanning for memories with overlays...")
     
-    for item in os.listdir(directory):
+    for item in sorted(os.listdir(directory)):
         item_path = os.path.join(directory, item)
         
         # Only process directories
@@ -257,9 +856,93 @@ def find_overlay_folders(directory):
     
     return overlay_folders
 
-def combine_image(base_path, overlay_path, output_path, quality=DEFAULT_JPEG_QUALITY):
+# Encoded JPEGs are built here; reused for every image a worker combines
+_image_buffer = io.BytesIO()
+
+def load_overlay_region(overlay_path, size):
+    """
+    Load the visible part of an overlay, scaled to an image of the given size
+    Returns (RGBA region, top-left position) or None if the overlay is fully transparent
+    """
+    with Image.open(overlay_path) as overlay:
+        overlay = overlay.convert('RGBA')
+    bbox = overlay.getchannel('A').getbbox()
+    if not bbox:
+        return None
+    
+    if overlay.size == size:
+        return overlay.crop(bbox), bbox[:2]
+    
+    # Scale the bounding box to the image, with room for the LANCZOS filter around it,
+    # and resize only that box - same pixels as resizing the whole overlay
+    scale_x = size[0] / overlay.size[0]
+    scale_y = size[1] / overlay.size[1]
+    margin_x = math.ceil(3 * max(scale_x, 1)) + 1
+    margin_y = math.ceil(3 * max(scale_y, 1)) + 1
+    left = max(0, math.floor(bbox[0] * scale_x) - margin_x)
+    top = max(0, math.floor(bbox[1] * scale_y) - margin_y)
+    right = min(size[0], math.ceil(bbox[2] * scale_x) + margin_x)
+    bottom = min(size[1], math.ceil(bbox[3] * scale_y) + margin_y)
+    source_box = (left / scale_x, top / scale_y, right / scale_x, bottom / scale_y)
+    region = overlay.resize((right - left, bottom - top), Image.Resampling.LANCZOS, box=source_box)
+    return region, (left, top)
+
+def check_jpegtran_drop_available():
+    """Check if jpegtran is installed and supports -drop (libjpeg 9+ or libjpeg-turbo 2.1+)"""
+    try:
+        result = subprocess.run(['jpegtran', '-help'], capture_output=True, text=True)
+    except FileNotFoundError:
+        return False
+    return '-drop' in result.stdout + result.stderr
+
+def write_lossless_region(base, region, output_path):
+    """
+    Write base with the overlay region composited, re-encoding only the MCU blocks it covers
+    The patch is encoded with the base's quantization tables and sampling and dropped into
+    the original JPEG by jpegtran, so every other block is copied bit for bit
+    Returns False if the base JPEG cannot be patched this way (FileNotFoundError if jpegtran is missing)
+    """
+    subsampling = JpegImagePlugin.get_sampling(base)
+    if base.format != 'JPEG' or base.mode != 'RGB' or subsampling == -1 or not getattr(base, 'layer', None):
+        return False
+    
+    # Grow the overlay's footprint to whole MCUs (16x16 for 4:2:0, 8x8 for 4:4:4)
+    overlay, (x, y) = region
+    mcu_width = 8 * max(layer[1] for layer in base.layer)
+    mcu_height = 8 * max(layer[2] for layer in base.layer)
+    left = x - x % mcu_width
+    top = y - y % mcu_height
+    right = min(base.width, math.ceil((x + overlay.width) / mcu_width) * mcu_width)
+    bottom = min(base.height, math.ceil((y + overlay.height) / mcu_height) * mcu_height)
+    
+    patch = base.crop((left, top, right, bottom))
+    patch.paste(overlay, (x - left, y - top), overlay)
+    
+    with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as patch_file:
+        patch_path = patch_file.name
+    try:
+        patch.save(patch_path, 'JPEG', qtables=base.quantization, subsampling=subsampling)
+        subprocess.run(
+            ['jpegtran', '-copy', 'all', '-drop', f'+{left}+{top}', patch_path,
+             '-outfile', output_path, base.filename],
+            capture_output=True,
+            check=True
+        )
+    except subprocess.CalledProcessError:
+        return False
+    finally:
+        os.remove(patch_path)
+    return True
+
+def combine_image(base_path, overlay_path, output_path, quality=DEFAULT_JPEG_QUALITY, jpeg_mode=DEFAULT_JPEG_MODE,
+                  jpegtran_available=True):
     """
     Composite overlay PNG onto base JPG image
+    Only the overlay's visible region is blended; the rest of the base is left as decoded
+    In 'lossless-region' mode the blocks outside that region are kept from the original JPEG
+    (falls back to re-encoding the whole image if that is not possible)
+    Returns the JPEG mode that was actually used ('fallback': re-encoded because jpegtran
+    is missing or jpegtran_available is False), or False on error
     Preserves EXIF metadata and file timestamps from overlay (which has correct date)
     Uses birth time (created date) which is not affected by metadata writes
     """
@@ -271,44 +954,149 @@ def combine_image(base_path, overlay_path, output_path, quality=DEFAULT_JPEG_QUA
         # Birth time is the creation date and doesn't change when metadata is written
         original_mtime = stat_info.st_birthtime if hasattr(stat_info, 'st_birthtime') else stat_info.st_mtime
         
-        # Load base image and overlay
-        base_img = Image.open(base_path)
-        base = base_img.convert('RGB')
-        overlay = Image.open(overlay_path).convert('RGBA')
+        # Load base image - decoded straight to RGB by libjpeg, so no converted copy is needed
+        base = Image.open(base_path)
+        exif_data = base.info.get('exif')
+        if base.format == 'JPEG':
+            base.draft('RGB', base.size)
+        if base.mode != 'RGB':
+            base = base.convert('RGB')
         
-        # Resize overlay to match base image dimensions if needed
-        if overlay.size != base.size:
-            overlay = overlay.resize(base.size, Image.Resampling.LANCZOS)
+        # Only the part of the overlay that has visible pixels is blended
+        region = load_overlay_region(overlay_path, base.size)
+        used_mode = 'reencode'
+        if jpeg_mode == 'lossless-region' and base.format == 'JPEG':
+            if not region:
+                # Nothing to blend - the original file is the combined image
+                shutil.copyfile(base_path, output_path)
+                os.utime(output_path, (original_atime, original_mtime))
+                return 'lossless-region'
+            try:
+                if not jpegtran_available:
+                    used_mode = 'fallback'
+                elif write_lossless_region(base, region, output_path):
+                    os.utime(output_path, (original_atime, original_mtime))
+                    return 'lossless-region'
+            except FileNotFoundError:
+                used_mode = 'fallback'
         
-        # Composite: paste overlay on top of base using alpha channel
-        base.paste(overlay, (0, 0), overlay)
+        if region:
+            overlay, position = region
+            base.paste(overlay, position, overlay)
         
-        # Try to preserve EXIF data using Pillow's built-in methods
-        exif_data = None
-        try:
-            exif_data = base_img.info.get('exif')
-        except Exception:
-            pass
-        
-        # Save combined image
+        # Encode into the worker's reused buffer and write the file in one go
+        _image_buffer.seek(0)
+        _image_buffer.truncate()
         if exif_data:
-            base.save(output_path, 'JPEG', quality=quality, exif=exif_data)
+            base.save(_image_buffer, 'JPEG', quality=quality, exif=exif_data)
         else:
-            base.save(output_path, 'JPEG', quality=quality)
+            base.save(_image_buffer, 'JPEG', quality=quality)
+        with open(output_path, 'wb') as f:
+            f.write(_image_buffer.getbuffer())
         
         # Restore original file timestamps
         os.utime(output_path, (original_atime, original_mtime))
         
-        return True
+        return used_mode
     except Exception as e:
         print(f"      ❌ Error combining image: {e}")
         return False
 
-def combine_video(base_path, overlay_path, output_path):
+def probe_video(path):
+    """
+    Read resolution, bitrate and duration of a video with ffprobe
+    Falls back to parsing `ffmpeg -i` output if ffprobe is not installed
+    Returns {} if the file cannot be read
+    """
+    try:
+        result = subprocess.run(
+            ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+             '-show_entries', 'stream=width,height,bit_rate:format=duration,bit_rate',
+             '-of', 'json', path],
+            capture_output=True,
+            text=True,
+            check=True
+        )
+        data = json.loads(result.stdout)
+    except FileNotFoundError:
+        return probe_video_with_ffmpeg(path)
+    except (subprocess.CalledProcessError, ValueError):
+        return {}
+    
+    stream = (data.get('streams') or [{}])[0]
+    container = data.get('format') or {}
+    info = {}
+    for key, value in (('width', stream.get('width')), ('height', stream.get('height')),
+                       ('bit_rate', stream.get('bit_rate') or container.get('bit_rate')),
+                       ('duration', container.get('duration'))):
+        try:
+            info[key] = float(value) if key == 'duration' else int(value)
+        except (TypeError, ValueError):
+            pass
+    return info
+
+def probe_video_with_ffmpeg(path):
+    """Same as probe_video, read from the stream summary ffmpeg prints for an input"""
+    try:
+        result = subprocess.run(['ffmpeg', '-hide_banner', '-i', path], capture_output=True, text=True)
+    except FileNotFoundError:
+        return {}
+    
+    info = {}
+    duration = re.search(r'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)', result.stderr)
+    if duration:
+        hours, minutes, seconds = duration.groups()
+        info['duration'] = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    video = re.search(r'Stream #.*?Video: .*?(\d{2,5})x(\d{2,5})(?:.*?(\d+) kb/s)?', result.stderr)
+    if video:
+        info['width'], info['height'] = int(video.group(1)), int(video.group(2))
+        if video.group(3):
+            info['bit_rate'] = int(video.group(3)) * 1000
+    return info
+
+def is_overlay_transparent(overlay_path):
+    """True if the overlay PNG has no visible pixel at all"""
+    with Image.open(overlay_path) as overlay:
+        if 'A' not in overlay.getbands() and 'transparency' not in overlay.info:
+            return False
+        return overlay.convert('RGBA').getchannel('A').getextrema()[1] == 0
+
+def build_encoder_args(profile_name, probe, threads=None):
+    """
+    ffmpeg video encoder arguments for a profile, matched to the probed source
+    Small videos get a lower CRF, and the bitrate is capped relative to the source bitrate -
+    or to the resolution when the bitrate is unknown
+    """
+    profile = VIDEO_PROFILES[profile_name]
+    width = probe.get('width') or 0
+    height = probe.get('height') or 0
+    crf = profile['crf']
+    for max_short_side, offset in VIDEO_CRF_OFFSETS:
+        if 0 < min(width, height) <= max_short_side:
+            crf += offset
+            break
+    args = ['-c:v', profile['codec'], '-preset', profile['preset'], '-crf', str(crf),
+            '-pix_fmt', 'yuv420p'] + profile.get('extra', [])
+    max_rate = None
+    if probe.get('bit_rate'):
+        # Constrained CRF: never spend much more than the source had
+        max_rate = int(probe['bit_rate'] * VIDEO_MAX_BITRATE_FACTOR)
+    elif width and height:
+        max_rate = int(width * height * 30 * VIDEO_FALLBACK_BITS_PER_PIXEL)
+    if max_rate:
+        args += ['-maxrate', str(max_rate), '-bufsize', str(2 * max_rate)]
+    threads = threads or profile.get('threads')
+    if threads:
+        # Share the cores with the other video jobs running in parallel
+        args += ['-threads', str(threads)]
+    return args
+
+def combine_video(base_path, overlay_path, output_path, threads=None, profile=DEFAULT_VIDEO_PROFILE, probe=None):
     """
     Burn overlay PNG onto video using ffmpeg
     Preserves video codec, audio, metadata, and file timestamps from overlay (which has correct date)
     Uses birth time (created date) which is not affected by metadata writes
+    The video is encoded with an encoder profile - or stream-copied if the overlay is fully transparent
     """
     try:
         # Get original file timestamps from overlay (overlay has correct date)
@@ -318,17 +1106,36 @@ def combine_video(base_path, overlay_path, output_path):
         # Birth time is the creation date and doesn't change when metadata is written
         original_mtime = stat_info.st_birthtime if hasattr(stat_info, 'st_birthtime') else stat_info.st_mtime
         
-        # ffmpeg command to overlay PNG on video
-        # Using overlay filter to composite the PNG on top
-        cmd = [
-            'ffmpeg',
-            '-i', base_path,           # Input video
-            '-i', overlay_path,        # Input overlay
-            '-filter_complex', '[0:v][1:v]overlay=0:0',  # Overlay at position 0,0
-            '-c:a', 'copy',            # Copy audio without re-encoding
-            '-y',                      # Overwrite output file
-            output_path
-        ]
+        if probe is None:
+            probe = probe_video(base_path)
+        
+        if is_overlay_transparent(overlay_path):
+            # Nothing to burn in - copy the streams, no re-encoding
+            cmd = [
+                'ffmpeg',
+                '-i', base_path,
+                '-c', 'copy',
+                '-y',
+                output_path
+            ]
+        else:
+            # ffmpeg command to overlay PNG on video
+            # Using overlay filter to composite the PNG on top, scaled to the decoded frames
+            # (not the probed size - rotated videos are auto-rotated, with width and height swapped).
+            # scale2ref pairs frames, so the single PNG frame is looped until the video ends
+            overlay_filter = ('[1:v]loop=loop=-1:size=1[looped];'
+                              '[looped][0:v]scale2ref=w=iw:h=ih[ov][base];'
+                              '[base][ov]overlay=0:0:shortest=1')
+            cmd = [
+                'ffmpeg',
+                '-i', base_path,           # Input video
+                '-i', overlay_path,        # Input overlay
+                '-filter_complex', overlay_filter,
+                *build_encoder_args(profile, probe, threads),
+                '-c:a', 'copy',            # Copy audio without re-encoding
+                '-y',                      # Overwrite output file
+                output_path
+            ]
         
         result = subprocess.run(
             cmd,
@@ -348,10 +1155,140 @@ def combine_video(base_path, overlay_path, output_path):
         print(f"      ❌ Error combining video: {e}")
         return False
 
-def process_overlay_combining(source_dir, output_dir, dry_run=True, quality=DEFAULT_JPEG_QUALITY, has_ffmpeg=False):
+def load_combine_state():
+    """Outputs created by earlier combine runs (empty if there is no readable state file)"""
+    if not os.path.exists(COMBINE_STATE_FILE):
+        return {}
+    try:
+        with open(COMBINE_STATE_FILE, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        return state if isinstance(state, dict) else {}
+    except (OSError, ValueError):
+        print(f"⚠️  '{COMBINE_STATE_FILE}' could not be read - combining everything again")
+        return {}
+
+def save_combine_state(state):
+    """Write the state file atomically"""
+    tmp_file = COMBINE_STATE_FILE + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(state, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_file, COMBINE_STATE_FILE)
+
+def get_file_signature(path):
+    """[size, mtime_ns] of a file, None if it does not exist"""
+    try:
+        stat_info = os.stat(path)
+        return [stat_info.st_size, stat_info.st_mtime_ns]
+    except OSError:
+        return None
+
+def get_input_signature(paths):
+    return [[path, get_file_signature(path)] for path in paths]
+
+def is_output_up_to_date(entry, input_signature, params, output_path, jpegtran_available=False):
+    """
+    True if the output exists unchanged and was built from the same inputs with the same settings
+    (the output's mtime is copied from the overlay, so it cannot be compared with the inputs)
+    An image that fell back to re-encoding for lack of jpegtran is rebuilt once jpegtran is available
+    """
+    if not entry or entry.get('version') != COMBINE_STATE_VERSION:
+        return False
+    if entry.get('jpeg_mode') == 'fallback' and jpegtran_available:
+        return False
+    return (entry.get('inputs') == input_signature and entry.get('params') == params
+            and entry.get('output') == get_file_signature(output_path))
+
+def record_combined_output(state, output_filename, input_signature, params, output_path, jpeg_mode=None):
+    """
+    Records a combined output with the settings it was requested with
+    jpeg_mode is the mode an image was actually written in (see combine_image)
+    """
+    state[output_filename] = {
+        'inputs': input_signature,
+        'params': params,
+        'output': get_file_signature(output_path),
+        'version': COMBINE_STATE_VERSION
+    }
+    if jpeg_mode:
+        state[output_filename]['jpeg_mode'] = jpeg_mode
+
+def run_combine_job(kind, base_path, overlay_path, output_path, options):
+    """
+    Run combine_image or combine_video in a worker process and return (success, printed output, stats)
+    The output is captured so it can be printed under the right folder, in order
+    (redirect_stdout swaps sys.stdout for the whole process, so never call this from a thread)
+    stats holds the job's wall time, for videos the video duration and for images the JPEG mode used
+    """
+    output = io.StringIO()
+    stats = {'seconds': 0.0, 'duration': 0.0, 'jpeg_mode': None}
+    start_time = time.time()
+    with contextlib.redirect_stdout(output):
+        if kind == 'image':
+            success = combine_image(base_path, overlay_path, output_path, **options)
+            stats['jpeg_mode'] = success or None
+        else:
+            probe = probe_video(base_path)
+            stats['duration'] = probe.get('duration', 0.0)
+            success = combine_video(base_path, overlay_path, output_path, probe=probe, **options)
+    stats['seconds'] = time.time() - start_time
+    return success, output.getvalue(), stats
+
+def format_video_speed(seconds, duration):
+    """Encoding time per minute of video, e.g. '12.3s per video-minute'"""
+    if not duration:
+        return 'unknown speed (video duration could not be read)'
+    return f"{seconds / (duration / 60):.1f}s per video-minute"
+
+def benchmark_video_profiles(source_dir, sample_size=BENCHMARK_SAMPLE_VIDEOS):
+    """
+    Encode a few videos with every profile and report seconds per video-minute
+    Outputs go to a temporary folder and are deleted afterwards
+    """
+    videos = [folder for folder in find_overlay_folders(source_dir)
+              if folder['is_video'] and not folder['is_image']
+              and not is_overlay_transparent(folder['overlays'][0])][:sample_size]
+    if not videos:
+        print("✅ No videos with overlays found!")
+        return
+    
+    probes = [probe_video(folder['base_video']) for folder in videos]
+    duration = sum(probe.get('duration', 0.0) for probe in probes)
+    print(f"\n⏱️  Benchmarking {len(VIDEO_PROFILES)} profiles on {len(videos)} video(s) ({duration:.1f}s of video)...")
+    print()
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for profile_name, profile in VIDEO_PROFILES.items():
+            start_time = time.time()
+            output_size = 0
+            failed = 0
+            for idx, (folder, probe) in enumerate(zip(videos, probes)):
+                output_path = os.path.join(tmp_dir, f'{profile_name}_{idx}.mp4')
+                with contextlib.redirect_stdout(io.StringIO()):
+                    success = combine_video(folder['base_video'], folder['overlays'][0], output_path,
+                                            profile=profile_name, probe=probe)
+                if success:
+                    output_size += os.path.getsize(output_path)
+                else:
+                    failed += 1
+            seconds = time.time() - start_time
+            
+            settings = f"{profile['codec']} {profile['preset']} crf {profile['crf']}"
+            if failed:
+                print(f"   ❌ {profile_name:<10} {settings:<28} failed for {failed} video(s) (encoder missing?)")
+            else:
+                print(f"   🎥 {profile_name:<10} {settings:<28} {format_video_speed(seconds, duration):<28} "
+                      f"{output_size / (1024 * 1024):.1f} MB")
+    print()
+    print(f"💡 Pick one with: python overlay-manager.py combine --execute --video-profile <name>")
+
+def process_overlay_combining(source_dir, output_dir, dry_run=True, quality=DEFAULT_JPEG_QUALITY, has_ffmpeg=False,
+                              jobs=1, video_jobs=DEFAULT_VIDEO_JOBS, force=False, video_profile=DEFAULT_VIDEO_PROFILE,
+                              jpeg_mode=DEFAULT_JPEG_MODE, jpegtran_available=False):
     """
     Main processing function for combining overlays
-    Finds all overlay folders and combines them
+    Finds all overlay folders and combines them (`jobs` images and `video_jobs` videos at a time)
+    Outputs whose inputs and settings did not change since the last run are skipped unless `force`
+    Without jpegtran, 'lossless-region' images are re-encoded and recorded as 'fallback'
     """
     # Find all folders with overlays
     overlay_folders = find_overlay_folders(source_dir)
@@ -384,73 +1321,120 @@ def process_overlay_combining(source_dir, output_dir, dry_run=True, quality=DEFA
     processed_images = 0
     processed_videos = 0
     skipped_videos = 0
+    up_to_date = 0
+    video_seconds = 0.0  # Wall time of the video jobs
+    video_duration = 0.0  # Length of the videos they produced
     errors = 0
     error_details = []  # Track error details
     
     total_folders = len(overlay_folders)
     
-    for idx, folder_info in enumerate(overlay_folders, 1):
-        folder_name = folder_info['folder_name']
-        print(f"[{idx}/{total_folders}] 📁 {folder_name}")
-        
+    # Queue every folder first: images on a process pool (Pillow is CPU-bound),
+    # videos on their own smaller pool so parallel ffmpeg jobs do not fight over cores.
+    # Both are process pools - run_combine_job captures stdout, which is only safe per process
+    image_pool = None
+    video_pool = None
+    video_threads = None
+    if not dry_run:
+        image_pool = ProcessPoolExecutor(max_workers=max(1, jobs))
+        video_pool = ProcessPoolExecutor(max_workers=max(1, video_jobs))
+        if video_jobs > 1:
+            video_threads = max(1, (os.cpu_count() or 1) // video_jobs)
+    
+    # Outputs recorded by earlier runs - unchanged inputs and settings are not combined again
+    combine_state = {} if force else load_combine_state()
+    
+    tasks = []
+    for folder_info in overlay_folders:
         # Determine output filename
         # Remove trailing slash and use folder name as base
-        output_filename = f"{folder_name}_combined"
+        output_filename = f"{folder_info['folder_name']}_combined"
+        task = {'folder': folder_info['folder_name'], 'kind': None, 'future': None}
         
         if folder_info['is_image']:
+            task['kind'] = 'image'
             output_filename += '.jpg'
+            task['inputs'] = [folder_info['base_image'], folder_info['overlays'][0]]  # Use first overlay
+            task['params'] = {'quality': quality, 'jpeg_mode': jpeg_mode}
+            pool = image_pool
+        elif folder_info['is_video'] and has_ffmpeg:
+            task['kind'] = 'video'
+            output_filename += '.mp4'
+            task['inputs'] = [folder_info['base_video'], folder_info['overlays'][0]]  # Use first overlay
+            task['params'] = {'profile': video_profile, **VIDEO_PROFILES[video_profile]}
+            pool = video_pool
+        elif folder_info['is_video']:
+            task['kind'] = 'skipped video'
+        
+        task['output'] = output_filename
+        if task['kind'] in ('image', 'video'):
             output_path = os.path.join(output_dir, output_filename)
+            task['signature'] = get_input_signature(task['inputs'])
+            if is_output_up_to_date(combine_state.get(output_filename), task['signature'],
+                                    task['params'], output_path, jpegtran_available):
+                task['kind'] = 'up to date'
+            elif not dry_run:
+                if task['kind'] == 'video':
+                    options = {'threads': video_threads, 'profile': video_profile}
+                else:
+                    options = dict(task['params'], jpegtran_available=jpegtran_available)
+                task['future'] = pool.submit(run_combine_job, task['kind'], *task['inputs'], output_path, options)
+        tasks.append(task)
+    
+    try:
+        # Report in folder order, each folder as soon as its job (and all before it) finished
+        for idx, task in enumerate(tasks, 1):
+            folder_name = task['folder']
+            kind = task['kind']
+            output_filename = task['output']
+            print(f"[{idx}/{total_folders}] 📁 {folder_name}")
             
-            if dry_run:
+            if kind == 'skipped video':
+                print(f"                ⏭️  Skipping video (ffmpeg not available)")
+                skipped_videos += 1
+            elif kind == 'up to date':
+                print(f"                ⏭️  Up to date: {output_filename}")
+                up_to_date += 1
+            elif kind and dry_run:
                 print(f"                Would create: {output_filename}")
-            else:
+                if kind == 'image':
+                    processed_images += 1
+                else:
+                    processed_videos += 1
+            elif kind:
                 print(f"                Creating: {output_filename}")
-                success = combine_image(
-                    folder_info['base_image'],
-                    folder_info['overlays'][0],  # Use first overlay
-                    output_path,
-                    quality
-                )
+                try:
+                    success, job_output, stats = task['future'].result()
+                except Exception as e:
+                    success, job_output, stats = False, f"      ❌ Error combining {kind}: {e}\n", None
+                if job_output:
+                    print(job_output, end='')
                 if success:
-                    processed_images += 1
+                    if kind == 'image':
+                        processed_images += 1
+                    else:
+                        processed_videos += 1
+                        video_seconds += stats['seconds']
+                        video_duration += stats['duration']
+                    record_combined_output(combine_state, output_filename, task['signature'],
+                                           task['params'], os.path.join(output_dir, output_filename),
+                                           jpeg_mode=stats['jpeg_mode'])
                     print(f"                ✅ Saved!")
                 else:
                     errors += 1
                     error_details.append({
                         'folder': folder_name,
-                        'type': 'image',
+                        'type': kind,
                         'output': output_filename
                     })
-        
-        elif folder_info['is_video']:
-            if not has_ffmpeg:
-                print(f"                ⏭️  Skipping video (ffmpeg not available)")
-                skipped_videos += 1
-            else:
-                output_filename += '.mp4'
-                output_path = os.path.join(output_dir, output_filename)
-                
-                if dry_run:
-                    print(f"                Would create: {output_filename}")
-                else:
-                    print(f"                Creating: {output_filename}")
-                    success = combine_video(
-                        folder_info['base_video'],
-                        folder_info['overlays'][0],  # Use first overlay
-                        output_path
-                    )
-                    if success:
-                        processed_videos += 1
-                        print(f"                ✅ Saved!")
-                    else:
-                        errors += 1
-                        error_details.append({
-                            'folder': folder_name,
-                            'type': 'video',
-                            'output': output_filename
-                        })
-        
-        print()
+            
+            print()
+    finally:
+        if image_pool is not None:
+            image_pool.shutdown(cancel_futures=True)
+            video_pool.shutdown(cancel_futures=True)
+            # Keep what was combined so far, even if the run is interrupted
+            save_combine_state(combine_state)
     
     print("🔄 Generating final report...")
     print()
@@ -464,8 +1448,10 @@ def process_overlay_combining(source_dir, output_dir, dry_run=True, quality=DEFA
         print("⚠️  DRY RUN MODE - No files created!")
         print()
         print(f"📊 Would create:")
-        print(f"   📷 Images: {image_count}")
-        print(f"   🎥 Videos: {video_count if has_ffmpeg else 0}")
+        print(f"   📷 Images: {processed_images}")
+        print(f"   🎥 Videos: {processed_videos}")
+        if up_to_date > 0:
+            print(f"   ⏭️  Already up to date: {up_to_date}")
         if skipped_videos > 0:
             print(f"   ⏭️  Skipped videos: {skipped_videos} (ffmpeg not available)")
         print()
@@ -475,6 +1461,10 @@ def process_overlay_combining(source_dir, output_dir, dry_run=True, quality=DEFA
         print(f"✅ Successfully created:")
         print(f"   📷 Images: {processed_images}")
         print(f"   🎥 Videos: {processed_videos}")
+        if processed_videos > 0:
+            print(f"   ⏱️  Video encoding ({video_profile}): {format_video_speed(video_seconds, video_duration)}")
+        if up_to_date > 0:
+            print(f"   ⏭️  Already up to date: {up_to_date}")
         if skipped_videos > 0:
             print(f"   ⏭️  Skipped videos: {skipped_videos} (ffmpeg not available)")
         if errors > 0:
@@ -501,6 +1491,11 @@ def handle_dedupe_command(args):
     """Handle the dedupe subcommand"""
     dry_run = not args.execute
     
+    # Validate threshold
+    if not 0 <= args.threshold <= 64:
+        print("❌ Threshold must be between 0 and 64")
+        sys.exit(1)
+    
     print("=" * 80)
     print("Deduplicate Snapchat Memories")
     print("=" * 80)
@@ -509,6 +1504,14 @@ def handle_dedupe_command(args):
     if dry_run:
         print("⚠️  DRY RUN MODE - Preview only, no changes")
         print()
+    elif args.link:
+        print(f"⚠️  WARNING: Duplicates will actually be replaced with {args.link}s!")
+        if not args.skip_prompt:
+            response = input("Continue? (y/n): ")
+            if response.lower() not in ['y', 'yes']:
+                print("Cancelled.")
+                return
+        print()
     else:
         print("⚠️  WARNING: Duplicates will actually be deleted!")
         if not args.skip_prompt:
@@ -518,7 +1521,10 @@ def handle_dedupe_command(args):
                 return
         print()
     
-    process_deduplication(SOURCE_FOLDER, dry_run=dry_run)
+    process_deduplication(SOURCE_FOLDER, dry_run=dry_run, scope=args.scope,
+                          keep_policy=args.keep, link_mode=args.link, use_cache=not args.no_cache,
+                          jobs=args.jobs, perceptual_threshold=args.threshold if args.perceptual else None,
+                          apply_similar=args.apply_similar)
 
 def handle_combine_command(args):
     """Handle the combine subcommand"""
@@ -559,6 +1565,21 @@ def handle_combine_command(args):
         print("   Linux: sudo apt-get install ffmpeg")
         print()
     
+    jpegtran_available = args.jpeg_mode == 'lossless-region' and check_jpegtran_drop_available()
+    if args.jpeg_mode == 'lossless-region' and not jpegtran_available:
+        print("⚠️  jpegtran with -drop support not found - images will be fully re-encoded")
+        print("   (and rebuilt losslessly by a later run once jpegtran is installed)")
+        print("   Install a recent libjpeg-turbo: brew install jpeg-turbo (macOS)")
+        print("   or sudo apt-get install libjpeg-turbo-progs (Linux)")
+        print()
+    
+    if args.benchmark:
+        if not has_ffmpeg:
+            print("❌ The benchmark needs ffmpeg")
+            sys.exit(1)
+        benchmark_video_profiles(SOURCE_FOLDER)
+        return
+    
     if dry_run:
         print("⚠️  DRY RUN MODE - Preview only, no files will be created")
         print()
@@ -566,7 +1587,10 @@ def handle_combine_command(args):
         print(f"Creating combined files in: {OUTPUT_FOLDER}/")
         print()
     
-    process_overlay_combining(SOURCE_FOLDER, OUTPUT_FOLDER, dry_run=dry_run, quality=args.quality, has_ffmpeg=has_ffmpeg)
+    process_overlay_combining(SOURCE_FOLDER, OUTPUT_FOLDER, dry_run=dry_run, quality=args.quality, has_ffmpeg=has_ffmpeg,
+                              jobs=args.jobs, video_jobs=args.video_jobs, force=args.force,
+                              video_profile=args.video_profile, jpeg_mode=args.jpeg_mode,
+                              jpegtran_available=jpegtran_available)
 
 def main():
     """Main entry point with subcommand parsing"""
@@ -581,6 +1605,15 @@ Examples:
   # Actually delete duplicates
   python overlay-manager.py dedupe --execute
   
+  # Find duplicates across the whole archive, keep the oldest copy, hardlink the rest
+  python overlay-manager.py dedupe --scope archive --keep oldest --link hardlink --execute
+  
+  # Also report re-encoded copies of the same photo, keep the biggest file
+  python overlay-manager.py dedupe --scope archive --perceptual --keep largest
+  
+  # ...and hardlink them to that file once the report looks right
+  python overlay-manager.py dedupe --scope archive --perceptual --keep largest --apply-similar --link hardlink --execute
+  
   # Combine overlays (dry run)
   python overlay-manager.py combine
   
@@ -589,6 +1622,9 @@ Examples:
   
   # Custom JPEG quality (lower values save space)
   python overlay-manager.py combine --execute --quality 90
+  
+  # Combine 8 images or 2 videos at a time
+  python overlay-manager.py combine --execute --jobs 8 --video-jobs 2
         """
     )
     
@@ -611,6 +1647,51 @@ Examples:
         action='store_true',
         help='Skip the confirmation prompt (for automation)'
     )
+    dedupe_parser.add_argument(
+        '--scope',
+        choices=['folder', 'archive'],
+        default='folder',
+        help='Compare files within each memory folder (default) or across the whole archive, top-level files included'
+    )
+    dedupe_parser.add_argument(
+        '--keep',
+        choices=KEEP_POLICIES,
+        default='folder-uuid',
+        help='Which copy to keep: the file named after its folder (default), the oldest/newest by date, the least nested one or the largest (best quality for --perceptual)'
+    )
+    dedupe_parser.add_argument(
+        '--link',
+        choices=['hardlink', 'reflink'],
+        default=None,
+        help='Replace duplicates with hardlinks or copy-on-write reflinks instead of deleting them (keeps every path)'
+    )
+    dedupe_parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help=f'Hash every file again instead of reusing hashes from {HASH_CACHE_FILE}'
+    )
+    dedupe_parser.add_argument(
+        '--jobs',
+        type=int,
+        default=DEFAULT_HASH_JOBS,
+        help=f'Files hashed in parallel (default: {DEFAULT_HASH_JOBS})'
+    )
+    dedupe_parser.add_argument(
+        '--perceptual',
+        action='store_true',
+        help='Also report images that look the same (re-encoded, resized) as near-duplicates'
+    )
+    dedupe_parser.add_argument(
+        '--threshold',
+        type=int,
+        default=DEFAULT_PERCEPTUAL_THRESHOLD,
+        help=f'Differing bits (0-64) for --perceptual matches (default: {DEFAULT_PERCEPTUAL_THRESHOLD}). Lower is stricter.'
+    )
+    dedupe_parser.add_argument(
+        '--apply-similar',
+        action='store_true',
+        help='Also delete (or link) the near-duplicates found by --perceptual - without it they are only reported'
+    )
     dedupe_parser.set_defaults(func=handle_dedupe_command)
     
     # Combine subcommand
@@ -629,11 +1710,47 @@ Examples:
         default=DEFAULT_JPEG_QUALITY,
         help=f'JPEG quality for combined images (1-100, default: {DEFAULT_JPEG_QUALITY}). Lower values (85-95) save disk space.'
     )
+    combine_parser.add_argument(
+        '--jpeg-mode',
+        choices=JPEG_MODES,
+        default=DEFAULT_JPEG_MODE,
+        help='reencode: re-encode the whole image at --quality (default). '
+             'lossless-region: keep the original JPEG outside the overlay and re-encode only the blocks under it '
+             '(smaller and faster, ignores --quality, needs jpegtran with -drop)'
+    )
     combine_parser.add_argument(
         '--skip-prompt',
         action='store_true',
         help='Skip the initial confirmation prompt (for automation)'
     )
+    combine_parser.add_argument(
+        '--video-profile',
+        choices=list(VIDEO_PROFILES),
+        default=DEFAULT_VIDEO_PROFILE,
+        help=f'Encoder profile for videos (default: {DEFAULT_VIDEO_PROFILE}). See --benchmark'
+    )
+    combine_parser.add_argument(
+        '--benchmark',
+        action='store_true',
+        help=f'Encode up to {BENCHMARK_SAMPLE_VIDEOS} videos with every profile and report seconds per video-minute (writes nothing)'
+    )
+    combine_parser.add_argument(
+        '--force',
+        action='store_true',
+        help=f'Combine every folder again, even if its output is up to date (see {COMBINE_STATE_FILE})'
+    )
+    combine_parser.add_argument(
+        '--jobs',
+        type=int,
+        default=DEFAULT_COMBINE_JOBS,
+        help=f'Images combined in parallel (default: {DEFAULT_COMBINE_JOBS})'
+    )
+    combine_parser.add_argument(
+        '--video-jobs',
+        type=int,
+        default=DEFAULT_VIDEO_JOBS,
+        help=f'Videos combined in parallel, ffmpeg threads are split between them (default: {DEFAULT_VIDEO_JOBS})'
+    )
     combine_parser.set_defaults(func=handle_combine_command)
     
     # Parse arguments and call appropriate handler
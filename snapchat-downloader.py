@@ -1,39 +1,145 @@
 import os
 import re
+import sys
 import json
+import time
+import heapq
+import random
+import signal
+import asyncio
+import argparse
 import requests
+from requests.adapters import HTTPAdapter
 import zipfile
 import shutil
 import subprocess
 import threading
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
+from email.utils import parsedate_to_datetime
 from pathlib import Path
+from exiftool_pool import ExifToolPool
+from native_metadata import write_native_metadata
+from memories_parser import (load_memories, get_index_path, check_integrity,
+                             print_integrity_report, extract_unique_id_from_url)
 
 # ---------------- CONFIG ----------------
 HTML_FILE = 'memories_history.html'
 DOWNLOAD_FOLDER = 'snapchat_memories'
 LOG_FILE = 'downloaded_files.json'
+JOURNAL_FILE = 'downloaded_files.jsonl'  # Append-only progress journal, compacted into LOG_FILE
+JOURNAL_COMPACT_EVERY = 500  # Compact the journal after this many appended records
 ERROR_LOG_FILE = 'download_errors.json'
-MAX_WORKERS = 5  # Number of parallel downloads
+MAX_WORKERS = 5  # Initial number of parallel downloads (adjusted at runtime)
+MAX_CONCURRENCY = 32  # Upper bound for the adaptive thread pool
+ADAPTIVE_WINDOW = 10  # Completed downloads per controller decision
+ADAPTIVE_DECREASE = 0.5  # Factor applied to concurrency on throttling or timeouts
+ADAPTIVE_LATENCY_TOLERANCE = 2.0  # Time-to-first-byte above best * this counts as congestion
+POOL_SIZE_PER_HOST = MAX_CONCURRENCY  # Kept-alive connections per host (one per worker)
+POOL_HOSTS = 10  # Number of hosts to keep connection pools for
 TEST_MODE = False  # Set to True for test mode
 TEST_FILES_PER_THREAD = 5  # Number of files per thread in test mode
 USE_EXIFTOOL = True  # Set to False if exiftool is not available
+USE_NATIVE_METADATA = True  # Patch JPEG/MP4 dates and JPEG GPS in-process, exiftool for the rest
+EXIFTOOL_WORKERS = 4  # Persistent exiftool processes shared by all download workers
+ASYNC_CONCURRENCY = 100  # In-flight requests for the async engine
+MAX_ATTEMPTS = 5  # Attempts per memory before it is logged as failed for this run
+RETRY_BASE_DELAY = 2  # Seconds before the first retry, doubled on every attempt
+RETRY_MAX_DELAY = 120  # Upper bound for the backoff (and for honoured Retry-After values)
+LIMITS_FILE = 'download_limits.json'  # Edit while running (or send SIGHUP) to change limits
+LIMITS_POLL_INTERVAL = 1.0  # Seconds between checks of LIMITS_FILE while data is streaming
 # ----------------------------------------
 
+def parse_rate(value):
+    """Parses '500K', '2M', '1.5G' or a plain number into bytes/sec (None = unlimited)"""
+    if value in (None, '', 0, '0'):
+        return None
+    if isinstance(value, (int, float)):
+        rate = float(value)
+    else:
+        units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+        text = value.strip().upper().rstrip('B')
+        try:
+            if text and text[-1] in units:
+                rate = float(text[:-1]) * units[text[-1]]
+            else:
+                rate = float(text)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"invalid rate '{value}' (use e.g. 500K, 2M or 1G)")
+    if rate < 0:
+        raise argparse.ArgumentTypeError(f"invalid rate '{value}' (must not be negative)")
+    return rate or None
+
+parser = argparse.ArgumentParser(description='Download Snapchat memories from memories_history.html')
+parser.add_argument(
+    '--engine',
+    choices=['threads', 'async'],
+    default='threads',
+    help='Download engine: thread pool (default) or asyncio (requires aiohttp)'
+)
+parser.add_argument(
+    '--concurrency',
+    type=int,
+    default=ASYNC_CONCURRENCY,
+    help=f'Concurrent requests for the async engine (default: {ASYNC_CONCURRENCY})'
+)
+parser.add_argument(
+    '--with-gps',
+    action='store_true',
+    help='Write GPS coordinates together with the date while downloading (one exiftool write per file)'
+)
+parser.add_argument(
+    '--limit-rate',
+    type=parse_rate,
+    default=None,
+    help='Total download bandwidth, e.g. 500K, 2M or 1G bytes/sec (default: unlimited)'
+)
+parser.add_argument(
+    '--max-rps',
+    type=float,
+    default=None,
+    help='Maximum requests per second across all workers (default: unlimited)'
+)
+args = parser.parse_args()
+
+if args.engine == 'async':
+    try:
+        import aiohttp
+    except ImportError:
+        print("❌ The async engine requires aiohttp: pip install aiohttp")
+        sys.exit(1)
+
 os.makedirs(DOWNLOAD_FOLDER, exist_ok=True)
 
 # Thread-lock for JSON write access
 json_lock = threading.Lock()
 error_lock = threading.Lock()
 
+def load_progress():
+    """Loads the last snapshot and replays the journal on top of it"""
+    files = {}
+    if os.path.exists(LOG_FILE):
+        with open(LOG_FILE, 'r', encoding='utf-8') as f:
+            files = json.load(f)
+    
+    replayed = 0
+    if os.path.exists(JOURNAL_FILE):
+        with open(JOURNAL_FILE, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    files[record['unique_id']] = record['entry']
+                    replayed += 1
+                except (json.JSONDecodeError, KeyError, TypeError):
+                    # Torn write from an interrupted run - everything before it is intact
+                    continue
+    
+    return files, replayed
+
 # Load already downloaded files (now with unique_id as key)
-if os.path.exists(LOG_FILE):
-    with open(LOG_FILE, 'r', encoding='utf-8') as f:
-        downloaded_files = json.load(f)
-else:
-    downloaded_files = {}
+downloaded_files, replayed_records = load_progress()
+journal_records = 0
+journal_handle = None
 
 # Load failed downloads
 if os.path.exists(ERROR_LOG_FILE):
@@ -42,32 +148,16 @@ if os.path.exists(ERROR_LOG_FILE):
 else:
     error_log = {}
 
-# Read and parse HTML
-with open(HTML_FILE, 'r', encoding='utf-8') as f:
-    html_content = f.read()
-
-soup = BeautifulSoup(html_content, 'html.parser')
-
-# Extract all downloadMemories links and associated data
-pattern = r"downloadMemories\('(.+?)',\s*this,\s*(true|false)\)"
-matches = re.findall(pattern, html_content)
-
-# Extract capture date from table
-def extract_dates_from_table():
-    """Extracts all capture dates from the table"""
-    dates = []
-    table = soup.select_one('body > div.rightpanel > table > tbody')
-    if table:
-        rows = table.find_all('tr')
-        for row in rows:
-            cells = row.find_all('td')
-            if cells:
-                date_text = cells[0].get_text(strip=True)
-                dates.append(date_text)
-    return dates
-
-dates = extract_dates_from_table()
-print(f"{len(matches)} files found, {len(dates)} date entries found.")
+# Read and parse HTML in a single streaming pass - one record per table row
+# (skipped entirely when the export is unchanged since the last run)
+memories, from_cache = load_memories(HTML_FILE)
+if from_cache:
+    print(f"⚡ Export unchanged - loaded from '{get_index_path(HTML_FILE)}'")
+print_integrity_report(check_integrity(memories))
+memories = [m for m in memories if m.url]
+dated_count = sum(1 for m in memories if m.date)
+memory_locations = {m.unique_id: m.location for m in memories if m.location}
+print(f"{len(memories)} files found, {dated_count} date entries found.")
 
 # Check if exiftool is available
 def check_exiftool():
@@ -80,20 +170,16 @@ def check_exiftool():
 
 exiftool_available = check_exiftool() if USE_EXIFTOOL else False
 if USE_EXIFTOOL and not exiftool_available:
-    print("WARNING: exiftool not found. Metadata will not be written.")
+    if USE_NATIVE_METADATA:
+        print("WARNING: exiftool not found. Metadata will only be written to JPEG and MP4/MOV files.")
+    else:
+        print("WARNING: exiftool not found. Metadata will not be written.")
     print("Installation: https://exiftool.org/")
 elif exiftool_available:
     print("exiftool found - Metadata will be written to files.")
 
-def extract_unique_id_from_url(url):
-    """Extracts the unique ID (mid) from the URL"""
-    mid_match = re.search(r'mid=([a-zA-Z0-9\-]+)', url)
-    if mid_match:
-        return mid_match.group(1)
-    else:
-        # Fallback: Hash of entire URL
-        import hashlib
-        return hashlib.md5(url.encode()).hexdigest()
+# Long-lived exiftool processes - Perl starts once per worker, not once per file
+exiftool_pool = ExifToolPool(size=EXIFTOOL_WORKERS)
 
 def get_file_extension_from_url(url):
     """Determines the file extension from the URL or Content-Type"""
@@ -143,6 +229,57 @@ def build_filename(unique_id, date_str=None, content_type=None, url=None):
     
     return filepath, filename
 
+def build_part_path(unique_id, date_str=None):
+    """Path of the partial download for a memory (known before the response arrives)"""
+    filepath, _ = build_filename(unique_id, date_str)
+    return os.path.splitext(filepath)[0] + '.part'
+
+def get_resume_headers(part_path):
+    """Returns the bytes already on disk and a Range header to continue from there"""
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    if offset > 0:
+        return offset, {'Range': f'bytes={offset}-'}
+    return 0, None
+
+class PartialResumeError(Exception):
+    """The server answered a resumed download with a range we cannot use - retried from byte zero"""
+
+def get_part_write_mode(status_code, content_range, offset):
+    """
+    Append if the server honoured our Range request, start over on a full response
+    Returns None for a partial response that does not start at our offset
+    """
+    if status_code != 206:
+        return 'wb'
+    # Content-Range: bytes 1000-1999/2000
+    range_match = re.match(r'bytes\s+(\d+)-', content_range or '')
+    if not range_match or int(range_match.group(1)) != offset:
+        return None
+    return 'ab' if offset > 0 else 'wb'
+
+def get_complete_size(content_range):
+    """Full size from the Content-Range of a 416 response ('bytes */2000'), or None"""
+    range_match = re.match(r'bytes\s+\*/(\d+)', content_range or '')
+    return int(range_match.group(1)) if range_match else None
+
+def guess_content_type(filepath):
+    """Content-Type for a finished .part file, from its first bytes"""
+    with open(filepath, 'rb') as f:
+        head = f.read(8)
+    if head.startswith(b'\xff\xd8'):
+        return 'image/jpeg'
+    if head.startswith(b'\x89PNG'):
+        return 'image/png'
+    if head.startswith(b'PK\x03\x04'):
+        return 'application/zip'
+    return 'video/mp4'
+
+def drop_part_file(part_path, reason):
+    """Deletes an unusable .part file so the retry downloads from byte zero"""
+    if os.path.exists(part_path):
+        os.remove(part_path)
+    raise PartialResumeError(reason)
+
 def extract_and_cleanup_zip(zip_path):
     """Extracts ZIP file and deletes the ZIP"""
     try:
@@ -174,14 +311,33 @@ def parse_date_string(date_str):
         pass
     return None
 
-def write_metadata_to_file(filepath, date_str, silent=False):
-    """Writes capture date to the file metadata"""
-    if not exiftool_available or not date_str:
-        return False
+def build_gps_args(location):
+    """exiftool arguments for GPS coordinates (same tags metadata.py writes)"""
+    if not location:
+        return []
+    latitude = location['latitude']
+    longitude = location['longitude']
+    return [
+        f'-GPSLatitude={abs(latitude)}',
+        f'-GPSLatitudeRef={"N" if latitude >= 0 else "S"}',
+        f'-GPSLongitude={abs(longitude)}',
+        f'-GPSLongitudeRef={"E" if longitude >= 0 else "W"}'
+    ]
+
+def write_metadata_to_file(filepath, date_str, silent=False, location=None):
+    """
+    Writes capture date (and GPS coordinates if given) to the file metadata
+    Both go into a single write: in-process where native_metadata supports the format,
+    otherwise a single exiftool call, so the file is only rewritten once
+    Returns (date written, GPS written) - without exiftool, a location native_metadata
+    cannot write is left out so the date still gets written (metadata.py adds it later)
+    """
+    if not (exiftool_available or USE_NATIVE_METADATA) or not date_str:
+        return False, False
     
     dt = parse_date_string(date_str)
     if not dt:
-        return False
+        return False, False
     
     try:
         exif_date = dt.strftime('%Y:%m:%d %H:%M:%S')
@@ -197,76 +353,389 @@ def write_metadata_to_file(filepath, date_str, silent=False):
                 os.utime(filepath, (timestamp, timestamp))
             except:
                 pass
-            return False
+            return False, False
         
-        if file_ext in ['.jpg', '.jpeg', '.png']:
-            result = subprocess.run([
-                'exiftool',
+        tags_written = True
+        if USE_NATIVE_METADATA and write_native_metadata(filepath, dt, location):
+            pass
+        elif not exiftool_available:
+            if not (location and USE_NATIVE_METADATA and write_native_metadata(filepath, dt)):
+                return False, False
+            location = None
+        elif file_ext in ['.jpg', '.jpeg', '.png']:
+            result = exiftool_pool.execute(
                 '-overwrite_original',
                 '-q',
                 f'-DateTimeOriginal={exif_date}',
                 f'-CreateDate={exif_date}',
                 f'-ModifyDate={exif_date}',
+                *build_gps_args(location),
                 filepath
-            ], capture_output=True)
+            )
             
-            if result.returncode != 0 and not silent:
-                return False
+            tags_written = result.returncode == 0
             
         elif file_ext in ['.mp4', '.mov', '.avi']:
-            result = subprocess.run([
-                'exiftool',
+            result = exiftool_pool.execute(
                 '-overwrite_original',
                 '-q',
                 f'-CreateDate={exif_date}',
                 f'-MediaCreateDate={exif_date}',
                 f'-TrackCreateDate={exif_date}',
                 f'-ModifyDate={exif_date}',
+                *build_gps_args(location),
                 filepath
-            ], capture_output=True)
+            )
             
-            if result.returncode != 0 and not silent:
-                return False
+            tags_written = result.returncode == 0
+        else:
+            # No metadata written for other formats, only the file date below
+            location = None
         
+        # The file date is set even when exiftool failed
         timestamp = dt.timestamp()
         os.utime(filepath, (timestamp, timestamp))
         
-        return True
+        if not tags_written:
+            return False, False
+        return True, location is not None
         
     except Exception as e:
         if not silent:
             print(f"⚠️  Could not write metadata for: {os.path.basename(filepath)}")
-        return False
+        return False, False
 
-def process_files_in_folder(folder_path, date_str):
+def process_files_in_folder(folder_path, date_str, location=None):
     """Writes metadata for all files in a folder (for extracted ZIPs)"""
     if not os.path.isdir(folder_path):
-        return
+        return 0, 0, 0
     
     success_count = 0
     skip_count = 0
+    gps_count = 0
     
     for root, dirs, files in os.walk(folder_path):
         for file in files:
             file_path = os.path.join(root, file)
             if file_path.lower().endswith(('.jpg', '.jpeg', '.png', '.mp4', '.mov', '.avi')):
-                result = write_metadata_to_file(file_path, date_str, silent=True)
+                result, gps_written = write_metadata_to_file(file_path, date_str, silent=True, location=location)
                 if result:
                     success_count += 1
                 else:
                     skip_count += 1
+                if gps_written:
+                    gps_count += 1
     
     if success_count > 0 or skip_count > 0:
         print(f"📦 {success_count} files with metadata written, {skip_count} skipped.")
+    
+    return success_count, skip_count, gps_count
+
+def create_session():
+    """Creates a shared HTTP session with a keep-alive connection pool per host"""
+    session = requests.Session()
+    session.headers.update({
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) '
+                     'AppleWebKit/537.36 (KHTML, like Gecko) '
+                     'Chrome/119.0.0.0 Safari/537.36',
+        # Byte offsets of resumed downloads must refer to the raw file, not a gzip stream
+        'Accept-Encoding': 'identity'
+    })
+    adapter = HTTPAdapter(pool_connections=POOL_HOSTS, pool_maxsize=POOL_SIZE_PER_HOST)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+# Shared by all workers so connections to the CDN are reused across files
+http_session = create_session()
+
+class RetryQueue:
+    """Thread-safe queue of failed tasks, ordered by the time they may run again"""
+    
+    def __init__(self):
+        self._heap = []
+        self._lock = threading.Lock()
+        self._counter = 0
+    
+    def __len__(self):
+        return len(self._heap)
+    
+    def push(self, delay, task):
+        with self._lock:
+            self._counter += 1
+            heapq.heappush(self._heap, (time.monotonic() + delay, self._counter, task))
+    
+    def pop_ready(self):
+        """Returns the next task whose backoff has expired, or None"""
+        with self._lock:
+            if self._heap and self._heap[0][0] <= time.monotonic():
+                return heapq.heappop(self._heap)[2]
+            return None
+    
+    def seconds_until_ready(self):
+        """Seconds until the next retry is due (None if the queue is empty)"""
+        with self._lock:
+            if not self._heap:
+                return None
+            return max(0.0, self._heap[0][0] - time.monotonic())
+
+retry_queue = RetryQueue()
+
+class ConcurrencyController:
+    """
+    AIMD controller for the number of downloads in flight
+    Doubles the limit until throughput stops rising (slow start), then grows it by one
+    per window while throughput rises and time-to-first-byte stays flat.
+    Throttling (429/5xx) and timeouts cut the limit multiplicatively.
+    """
+    
+    def __init__(self, initial, maximum, minimum=1, window=ADAPTIVE_WINDOW):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = max(minimum, min(initial, maximum))
+        self.window = window
+        self.slow_start = True
+        self.best_latency = None
+        self.last_latency = None
+        self.last_throughput = None
+        self._lock = threading.Lock()
+        self._reset_window()
+    
+    def _reset_window(self):
+        self._window_start = time.monotonic()
+        self._window_files = 0
+        self._window_bytes = 0
+        self._window_latency = 0.0
+        self._decreased = False
+    
+    def record_success(self, latency, nbytes):
+        """Feeds one finished download (time to first byte, bytes received)"""
+        with self._lock:
+            self._window_files += 1
+            self._window_bytes += nbytes
+            self._window_latency += latency
+            if self._window_files < self.window:
+                return
+            
+            elapsed = max(time.monotonic() - self._window_start, 1e-6)
+            throughput = self._window_bytes / elapsed
+            avg_latency = self._window_latency / self._window_files
+            if self.best_latency is None or avg_latency < self.best_latency:
+                self.best_latency = avg_latency
+            
+            rising = self.last_throughput is None or throughput > self.last_throughput * 1.05
+            if avg_latency > self.best_latency * ADAPTIVE_LATENCY_TOLERANCE:
+                # Requests are queueing somewhere - back off gently
+                self.limit = max(self.minimum, self.limit - 1)
+                self.slow_start = False
+            elif rising:
+                grown = self.limit * 2 if self.slow_start else self.limit + 1
+                self.limit = min(self.maximum, grown)
+            else:
+                # Throughput has flattened out - hold here
+                self.slow_start = False
+            
+            self.last_throughput = throughput
+            self.last_latency = avg_latency
+            self._reset_window()
+    
+    def record_congestion(self):
+        """Feeds a throttled, failed or timed-out request"""
+        with self._lock:
+            # One cut per window, so a burst of 429s does not collapse the pool to 1
+            if self._decreased:
+                return
+            self.limit = max(self.minimum, int(self.limit * ADAPTIVE_DECREASE))
+            self.slow_start = False
+            self.last_throughput = None
+            self._reset_window()
+            self._decreased = True
+    
+    def describe(self):
+        """Short status for the progress output"""
+        phase = 'slow start' if self.slow_start else 'AIMD'
+        text = f"Concurrency: {self.limit}/{self.maximum} ({phase}"
+        if self.last_throughput is not None:
+            text += f", {self.last_throughput / (1024 * 1024):.1f} MB/s"
+        if self.last_latency is not None:
+            text += f", TTFB {self.last_latency * 1000:.0f} ms"
+        return text + ")"
+
+class TokenBucket:
+    """Thread-safe token bucket - a rate of None means unlimited"""
+    
+    def __init__(self, rate=None):
+        self._lock = threading.Lock()
+        self.tokens = 0.0
+        self.set_rate(rate)
+    
+    def set_rate(self, rate):
+        with self._lock:
+            self.rate = rate
+            # Allow bursts of up to one second worth of tokens
+            self.capacity = rate or 0
+            self.tokens = min(self.tokens, self.capacity)
+            self.updated = time.monotonic()
+    
+    def reserve(self, amount):
+        """Takes `amount` tokens and returns how many seconds the caller has to wait"""
+        if self.rate is None:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Tokens may go negative: the debt is paid off by waiting
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+bandwidth_limit = TokenBucket(args.limit_rate)
+request_limit = TokenBucket(args.max_rps or None)
+limits_mtime = None
+reload_limits = False
+limits_checked = 0.0
+limits_lock = threading.Lock()
+
+def get_chunk_size():
+    """Full 1 MB chunks when unlimited, smaller ones to keep a limited stream smooth"""
+    if bandwidth_limit.rate is None:
+        return 1024 * 1024
+    return int(min(1024 * 1024, max(16 * 1024, bandwidth_limit.rate / 8)))
+
+def describe_limits():
+    """Short description of the active limits"""
+    rate = bandwidth_limit.rate
+    rps = request_limit.rate
+    return (f"{rate / 1024:.0f} KB/s" if rate else "unlimited bandwidth") + ", " + \
+           (f"{rps:g} req/s" if rps else "unlimited requests")
+
+def check_limits_file(keep=()):
+    """
+    Applies the limits from LIMITS_FILE when it changes or SIGHUP was received
+    Limits named in `keep` ('limit_rate', 'max_rps') are left as they are
+    """
+    global limits_mtime, reload_limits
+    with limits_lock:
+        try:
+            mtime = os.path.getmtime(LIMITS_FILE)
+        except OSError:
+            return
+        if mtime == limits_mtime and not reload_limits:
+            return
+        limits_mtime = mtime
+        reload_limits = False
+        try:
+            with open(LIMITS_FILE, 'r', encoding='utf-8') as f:
+                limits = json.load(f)
+            if 'limit_rate' in limits and 'limit_rate' not in keep:
+                bandwidth_limit.set_rate(parse_rate(limits['limit_rate']))
+            if 'max_rps' in limits and 'max_rps' not in keep:
+                request_limit.set_rate(float(limits['max_rps']) if limits['max_rps'] else None)
+            print(f"🎚️  Limits updated from '{LIMITS_FILE}': {describe_limits()}")
+        except Exception as e:
+            print(f"⚠️  Could not apply '{LIMITS_FILE}': {e}")
+
+def poll_limits_file():
+    """check_limits_file for the download loops - at most once per LIMITS_POLL_INTERVAL"""
+    global limits_checked
+    now = time.monotonic()
+    if now - limits_checked < LIMITS_POLL_INTERVAL:
+        return
+    limits_checked = now
+    check_limits_file()
+
+def handle_sighup(signum, frame):
+    """Forces LIMITS_FILE to be re-read within LIMITS_POLL_INTERVAL"""
+    global reload_limits
+    reload_limits = True
+
+if hasattr(signal, 'SIGHUP'):
+    signal.signal(signal.SIGHUP, handle_sighup)
+
+controller = ConcurrencyController(
+    MAX_WORKERS, args.concurrency if args.engine == 'async' else MAX_CONCURRENCY
+)
+
+def parse_retry_after(value):
+    """Parses a Retry-After header (seconds or HTTP date) into seconds"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+        return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def classify_error(error):
+    """Returns (HTTP status, Retry-After seconds, retryable) for a failed download"""
+    status = None
+    headers = {}
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        status = error.response.status_code
+        headers = error.response.headers
+    elif args.engine == 'async' and isinstance(error, aiohttp.ClientResponseError):
+        status = error.status
+        headers = error.headers or {}
+    
+    if status is not None:
+        # Throttling and server errors are transient; 403 means the link expired
+        retryable = status in (408, 429) or status >= 500
+        return status, parse_retry_after(headers.get('Retry-After')), retryable
+    
+    transient = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+                 TimeoutError, asyncio.TimeoutError, PartialResumeError)
+    if args.engine == 'async':
+        transient += (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError)
+    return None, None, isinstance(error, transient)
+
+def is_congestion(error, status):
+    """True for errors that mean we are sending too much: throttling, overload, timeouts"""
+    if status is not None:
+        return status == 429 or status >= 500
+    timeouts = (requests.Timeout, TimeoutError, asyncio.TimeoutError)
+    return isinstance(error, timeouts)
 
-def log_error(unique_id, url, date_str, error_message, index):
-    """Saves failed downloads to separate JSON file"""
+def get_retry_delay(error, attempt):
+    """Backoff with jitter for a retryable error, or None if the error is terminal"""
+    status, retry_after, retryable = classify_error(error)
+    if not retryable or attempt >= MAX_ATTEMPTS:
+        return status, None
+    
+    # Exponential backoff with "equal jitter": half fixed, half random
+    backoff = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1))
+    delay = backoff / 2 + random.uniform(0, backoff / 2)
+    if retry_after is not None:
+        if retry_after > RETRY_MAX_DELAY:
+            # Server wants us gone for longer than we are willing to wait in-process
+            return status, None
+        delay = max(delay, retry_after)
+    return status, delay
+
+def log_error(unique_id, url, date_str, error_message, index, attempt=1, status=None, retry_delay=None):
+    """Saves failed downloads to separate JSON file, including every attempt made"""
     with error_lock:
+        previous = error_log.get(unique_id, {})
+        attempts = previous.get('attempts', [])
+        attempts.append({
+            'attempt': attempt,
+            'error': str(error_message),
+            'status': status,
+            'retry_in': round(retry_delay, 1) if retry_delay is not None else None,
+            'timestamp': datetime.now().isoformat()
+        })
         error_log[unique_id] = {
             'url': url,
             'date': date_str,
             'error': str(error_message),
             'index': index,
+            'state': 'retrying' if retry_delay is not None else 'failed',
+            'attempts': attempts,
             'timestamp': datetime.now().isoformat()
         }
         try:
@@ -275,7 +744,72 @@ def log_error(unique_id, url, date_str, error_message, index):
         except Exception as e:
             print(f"❌ Error saving error list: {e}")
 
-def download_file(url, is_get_request, date_str=None, index=None):
+def handle_download_error(unique_id, url, is_get_request, date_str, error, index, attempt):
+    """Logs a failed attempt and schedules a retry if the error class allows it"""
+    status, retry_delay = get_retry_delay(error, attempt)
+    if is_congestion(error, status):
+        controller.record_congestion()
+    log_error(unique_id, url, date_str, error, index, attempt, status, retry_delay)
+    
+    if retry_delay is None:
+        print(f"❌ Download failed for {unique_id} (Index {index}): {error}")
+        return unique_id, 'error'
+    
+    print(f"🔁 Retrying {unique_id} in {retry_delay:.1f}s "
+          f"(attempt {attempt + 1}/{MAX_ATTEMPTS}): {error}")
+    retry_queue.push(retry_delay, (url, is_get_request, date_str, index, attempt + 1))
+    return unique_id, 'retry'
+
+def split_request(url, is_get_request):
+    """Returns method, URL and body for a downloadMemories link"""
+    if is_get_request:
+        return 'GET', url, None
+    parts = url.split('?')
+    post_url = parts[0]
+    post_data = parts[1] if len(parts) > 1 else ''
+    return 'POST', post_url, post_data
+
+def finish_download(unique_id, url, date_str, content_type, filepath, filename):
+    """Writes metadata, extracts ZIPs and records a completed download"""
+    # With --with-gps, date and location go into the file in the same write
+    location = memory_locations.get(unique_id) if args.with_gps else None
+    
+    # Write metadata
+    metadata_written, gps_written = write_metadata_to_file(filepath, date_str, location=location)
+    
+    # If ZIP, extract and write metadata for contents
+    if filepath.endswith('.zip'):
+        extract_folder = extract_and_cleanup_zip(filepath)
+        if extract_folder:
+            _, _, gps_count = process_files_in_folder(extract_folder, date_str, location)
+            gps_written = gps_count > 0
+    
+    # Save with unique_id as key
+    downloaded_files[unique_id] = {
+        'filename': filename,
+        'url': url,
+        'date': date_str,
+        'content_type': content_type,
+        'metadata_written': metadata_written,
+        'gps_written': gps_written,
+        'timestamp': datetime.now().isoformat()
+    }
+    
+    # Remove from error_log if it was previously failed (retry success)
+    if unique_id in error_log:
+        with error_lock:
+            del error_log[unique_id]
+            try:
+                with open(ERROR_LOG_FILE, 'w', encoding='utf-8') as f:
+                    json.dump(error_log, f, indent=2, ensure_ascii=False)
+            except Exception as e:
+                print(f"⚠️  Could not update error log: {e}")
+    
+    details = ' (metadata + GPS written)' if gps_written else ' (metadata written)' if metadata_written else ''
+    print(f"✅ {filename} downloaded{details}.")
+    return unique_id, 'downloaded'
+
+def download_file(url, is_get_request, date_str=None, index=None, attempt=1):
     """Downloads a file with correct file extension"""
     unique_id = extract_unique_id_from_url(url)
     
@@ -285,87 +819,185 @@ def download_file(url, is_get_request, date_str=None, index=None):
         return unique_id, 'skipped'
     
     try:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) '
-                         'AppleWebKit/537.36 (KHTML, like Gecko) '
-                         'Chrome/119.0.0.0 Safari/537.36'
-        }
+        # Continue a previously interrupted download if there is one
+        part_path = build_part_path(unique_id, date_str)
+        offset, range_headers = get_resume_headers(part_path)
         
         # Request to determine Content-Type
-        if is_get_request:
-            r = requests.get(url, headers=headers, stream=True, allow_redirects=True, timeout=60)
-        else:
-            parts = url.split('?')
-            post_url = parts[0]
-            post_data = parts[1] if len(parts) > 1 else ''
-            r = requests.post(post_url, headers=headers, data=post_data,
-                            stream=True, allow_redirects=True, timeout=60)
+        method, request_url, post_data = split_request(url, is_get_request)
+        delay = request_limit.reserve(1)
+        if delay:
+            time.sleep(delay)
+        started = time.monotonic()
+        r = http_session.request(method, request_url, data=post_data, headers=range_headers,
+                                 stream=True, allow_redirects=True, timeout=60)
+        first_byte = time.monotonic() - started
         
-        r.raise_for_status()
-        
-        content_type = r.headers.get('Content-Type', '')
-        
-        # Generate filename (without suffix logic)
-        filepath, filename = build_filename(unique_id, date_str, content_type, url)
+        # Closing the response hands the connection back to the pool
+        with r:
+            if r.status_code == 416:
+                if get_complete_size(r.headers.get('Content-Range')) == offset:
+                    # The .part already holds the whole file - the last run stopped before moving it
+                    content_type = guess_content_type(part_path)
+                    filepath, filename = build_filename(unique_id, date_str, content_type, url)
+                    os.replace(part_path, filepath)
+                    return finish_download(unique_id, url, date_str, content_type, filepath, filename)
+                drop_part_file(part_path, f"Server cannot resume at byte {offset} (416)")
+            r.raise_for_status()
+            
+            content_type = r.headers.get('Content-Type', '')
+            
+            # Generate filename (without suffix logic)
+            filepath, filename = build_filename(unique_id, date_str, content_type, url)
+            
+            # Download into the .part file and move it into place once complete
+            mode = get_part_write_mode(r.status_code, r.headers.get('Content-Range'), offset)
+            if mode is None:
+                drop_part_file(part_path, f"Server sent '{r.headers.get('Content-Range')}' for a resume at byte {offset}")
+            if mode == 'ab':
+                print(f"↪️  Resuming {filename} at {offset} bytes")
+            received = 0
+            with open(part_path, mode) as f:
+                for chunk in r.iter_content(get_chunk_size()):
+                    f.write(chunk)
+                    received += len(chunk)
+                    # A long download should still pick up limits changed while it runs
+                    poll_limits_file()
+                    delay = bandwidth_limit.reserve(len(chunk))
+                    if delay:
+                        time.sleep(delay)
+            os.replace(part_path, filepath)
         
-        # Download file
-        with open(filepath, 'wb') as f:
-            for chunk in r.iter_content(1024*1024):
-                f.write(chunk)
+        controller.record_success(first_byte, received)
         
-        # Write metadata
-        metadata_written = write_metadata_to_file(filepath, date_str)
+        return finish_download(unique_id, url, date_str, content_type, filepath, filename)
         
-        # If ZIP, extract and write metadata for contents
-        if filepath.endswith('.zip'):
-            extract_folder = extract_and_cleanup_zip(filepath)
-            if extract_folder:
-                process_files_in_folder(extract_folder, date_str)
+    except Exception as e:
+        return handle_download_error(unique_id, url, is_get_request, date_str, e, index, attempt)
+
+async def download_file_async(session, url, is_get_request, date_str=None, index=None, attempt=1):
+    """Async variant of download_file - same skip, ZIP and error handling"""
+    unique_id = extract_unique_id_from_url(url)
+    
+    # Check if already downloaded (by unique_id)
+    if unique_id in downloaded_files:
+        print(f"⏭️  {unique_id} already downloaded.")
+        return unique_id, 'skipped'
+    
+    try:
+        part_path = build_part_path(unique_id, date_str)
+        offset, range_headers = get_resume_headers(part_path)
         
-        # Save with unique_id as key
-        downloaded_files[unique_id] = {
-            'filename': filename,
-            'url': url,
-            'date': date_str,
-            'content_type': content_type,
-            'metadata_written': metadata_written,
-            'timestamp': datetime.now().isoformat()
-        }
+        method, request_url, post_data = split_request(url, is_get_request)
+        delay = request_limit.reserve(1)
+        if delay:
+            await asyncio.sleep(delay)
+        started = time.monotonic()
+        async with session.request(method, request_url, data=post_data, headers=range_headers,
+                                   allow_redirects=True) as r:
+            first_byte = time.monotonic() - started
+            if r.status == 416:
+                if get_complete_size(r.headers.get('Content-Range')) == offset:
+                    content_type = guess_content_type(part_path)
+                    filepath, filename = build_filename(unique_id, date_str, content_type, url)
+                    os.replace(part_path, filepath)
+                    return await asyncio.to_thread(
+                        finish_download, unique_id, url, date_str, content_type, filepath, filename
+                    )
+                drop_part_file(part_path, f"Server cannot resume at byte {offset} (416)")
+            r.raise_for_status()
+            
+            content_type = r.headers.get('Content-Type', '')
+            filepath, filename = build_filename(unique_id, date_str, content_type, url)
+            
+            # Stream in fixed-size chunks so memory stays bounded per request
+            mode = get_part_write_mode(r.status, r.headers.get('Content-Range'), offset)
+            if mode is None:
+                drop_part_file(part_path, f"Server sent '{r.headers.get('Content-Range')}' for a resume at byte {offset}")
+            if mode == 'ab':
+                print(f"↪️  Resuming {filename} at {offset} bytes")
+            received = 0
+            with open(part_path, mode) as f:
+                async for chunk in r.content.iter_chunked(get_chunk_size()):
+                    f.write(chunk)
+                    received += len(chunk)
+                    poll_limits_file()
+                    delay = bandwidth_limit.reserve(len(chunk))
+                    if delay:
+                        await asyncio.sleep(delay)
+            os.replace(part_path, filepath)
         
-        # Remove from error_log if it was previously failed (retry success)
-        if unique_id in error_log:
-            with error_lock:
-                del error_log[unique_id]
-                try:
-                    with open(ERROR_LOG_FILE, 'w', encoding='utf-8') as f:
-                        json.dump(error_log, f, indent=2, ensure_ascii=False)
-                except Exception as e:
-                    print(f"⚠️  Could not update error log: {e}")
+        controller.record_success(first_byte, received)
         
-        print(f"✅ {filename} downloaded{' (metadata written)' if metadata_written else ''}.")
-        return unique_id, 'downloaded'
+        # exiftool and ZIP extraction block, so keep them off the event loop
+        return await asyncio.to_thread(
+            finish_download, unique_id, url, date_str, content_type, filepath, filename
+        )
         
     except Exception as e:
-        print(f"❌ Download failed for {unique_id} (Index {index}): {e}")
-        log_error(unique_id, url, date_str, e, index)
-        return unique_id, 'error'
+        return await asyncio.to_thread(
+            handle_download_error, unique_id, url, is_get_request, date_str, e, index, attempt
+        )
+
+def append_progress(unique_id):
+    """Appends one completed download to the journal (Thread-safe)"""
+    global journal_handle, journal_records
+    with json_lock:
+        try:
+            if journal_handle is None:
+                journal_handle = open(JOURNAL_FILE, 'a', encoding='utf-8')
+            record = {'unique_id': unique_id, 'entry': downloaded_files[unique_id]}
+            journal_handle.write(json.dumps(record, ensure_ascii=False) + '\n')
+            journal_handle.flush()
+            journal_records += 1
+        except Exception as e:
+            print(f"❌ Error saving progress: {e}")
+            return False
+    
+    if journal_records >= JOURNAL_COMPACT_EVERY:
+        return save_progress()
+    return True
 
 def save_progress():
-    """Saves current progress to JSON file (Thread-safe)"""
+    """Compacts the journal into the JSON snapshot (Thread-safe)"""
+    global journal_handle, journal_records
     with json_lock:
         try:
-            with open(LOG_FILE, 'w', encoding='utf-8') as f:
-                json.dump(downloaded_files, f, indent=2, ensure_ascii=False)
+            # Write the snapshot atomically, then start a fresh journal
+            snapshot = dict(downloaded_files)
+            tmp_file = LOG_FILE + '.tmp'
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(snapshot, f, indent=2, ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, LOG_FILE)
+            
+            if journal_handle is not None:
+                journal_handle.close()
+                journal_handle = None
+            if os.path.exists(JOURNAL_FILE):
+                os.remove(JOURNAL_FILE)
+            journal_records = 0
             return True
         except Exception as e:
             print(f"❌ Error saving progress: {e}")
             return False
 
+# Recover from an interrupted run: fold the replayed journal into the snapshot
+if os.path.exists(JOURNAL_FILE):
+    if replayed_records > 0:
+        print(f"♻️  Recovered {replayed_records} entries from '{JOURNAL_FILE}'.")
+    save_progress()
+
 # Prepare download list
 download_tasks = []
-for i, (url, is_get) in enumerate(matches):
-    date_str = dates[i] if i < len(dates) else None
-    download_tasks.append((url, is_get == 'true', date_str, i))
+queued_ids = set()
+for i, memory in enumerate(memories):
+    # A memory listed twice would otherwise be downloaded by two workers at once
+    if memory.unique_id in queued_ids:
+        continue
+    queued_ids.add(memory.unique_id)
+    download_tasks.append((memory.url, memory.is_get, memory.date, i, 1))
 
 # Test mode: Limit number of downloads
 if TEST_MODE:
@@ -378,33 +1010,122 @@ print(f"\nAlready downloaded: {len(downloaded_files)} files")
 print(f"Failed downloads: {len(error_log)} files")
 print(f"To process: {len(download_tasks)} files\n")
 
+# Pick up limits left in the control file by an earlier run - limits given on the
+# command line win, later edits of the file apply to everything again
+check_limits_file(keep=[name for name in ('limit_rate', 'max_rps') if getattr(args, name) is not None])
+if bandwidth_limit.rate or request_limit.rate:
+    print(f"🎚️  Rate limits: {describe_limits()}\n")
+
 # Parallel downloads
 completed_count = 0
 downloaded_count = 0
 skipped_count = 0
 error_count = 0
+retry_count = 0
 total_count = len(download_tasks)
 
-with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-    futures = [executor.submit(download_file, url, is_get, date, idx) 
-               for url, is_get, date, idx in download_tasks]
+def record_result(unique_id, status):
+    """Updates counters and progress output for one finished task"""
+    global completed_count, downloaded_count, skipped_count, error_count, retry_count
+    if status == 'retry':
+        # Not finished yet - the task is back in the retry queue
+        retry_count += 1
+        return
     
-    for future in as_completed(futures):
-        unique_id, status = future.result()
-        completed_count += 1
+    completed_count += 1
+    check_limits_file()
+    
+    if status == 'downloaded':
+        downloaded_count += 1
+        append_progress(unique_id)
+    elif status == 'skipped':
+        skipped_count += 1
+    elif status == 'error':
+        error_count += 1
         
-        if status == 'downloaded':
-            downloaded_count += 1
-            save_progress()
-        elif status == 'skipped':
-            skipped_count += 1
-        elif status == 'error':
-            error_count += 1
+    # Progress display
+    if completed_count % 10 == 0 or completed_count == total_count:
+        print(f"\n📊 Progress: {completed_count}/{total_count} files processed "
+              f"(Downloaded: {downloaded_count}, Skipped: {skipped_count}, Errors: {error_count}, "
+              f"Retries: {retry_count})")
+        print(f"   ⚙️  {controller.describe()}\n")
+
+def next_task(pending):
+    """Due retries first, then fresh work - so workers never wait on a backoff"""
+    task = retry_queue.pop_ready()
+    if task is None:
+        task = next(pending, None)
+    return task
+
+def run_thread_engine(tasks):
+    """Downloads all tasks with a pool of OS threads"""
+    pending = iter(tasks)
+    with ThreadPoolExecutor(max_workers=controller.maximum) as executor:
+        in_flight = set()
+        while True:
+            # Keep as many downloads in flight as the controller currently allows
+            while len(in_flight) < controller.limit:
+                task = next_task(pending)
+                if task is None:
+                    break
+                in_flight.add(executor.submit(download_file, *task))
+            
+            if not in_flight:
+                retry_wait = retry_queue.seconds_until_ready()
+                if retry_wait is None:
+                    break
+                time.sleep(retry_wait)
+                continue
             
-        # Progress display
-        if completed_count % 10 == 0 or completed_count == total_count:
-            print(f"\n📊 Progress: {completed_count}/{total_count} files processed "
-                  f"(Downloaded: {downloaded_count}, Skipped: {skipped_count}, Errors: {error_count})\n")
+            # Wake up for a due retry only if there is a free slot to start it in -
+            # with every slot busy only a finished download can change anything
+            retry_wait = None
+            if len(in_flight) < controller.limit:
+                retry_wait = retry_queue.seconds_until_ready()
+            done, in_flight = wait(in_flight, timeout=retry_wait, return_when=FIRST_COMPLETED)
+            for future in done:
+                unique_id, status = future.result()
+                record_result(unique_id, status)
+
+async def run_async_engine(tasks, concurrency):
+    """Downloads all tasks with a fixed number of asyncio workers"""
+    connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=concurrency)
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=60, sock_read=60)
+    # POST bodies go out without a Content-Type, exactly like the requests engine
+    async with aiohttp.ClientSession(headers=dict(http_session.headers), connector=connector,
+                                     timeout=timeout, skip_auto_headers=['Content-Type']) as session:
+        # Workers pull from one shared iterator, so only `concurrency` tasks exist at a time
+        pending = iter(tasks)
+        in_flight = 0
+        
+        async def worker():
+            nonlocal in_flight
+            while True:
+                # Workers above the controller's current limit stay parked
+                if in_flight >= controller.limit:
+                    await asyncio.sleep(0.05)
+                    continue
+                task = next_task(pending)
+                if task is None:
+                    retry_wait = retry_queue.seconds_until_ready()
+                    if retry_wait is None:
+                        return
+                    await asyncio.sleep(retry_wait)
+                    continue
+                in_flight += 1
+                try:
+                    unique_id, status = await download_file_async(session, *task)
+                finally:
+                    in_flight -= 1
+                record_result(unique_id, status)
+        
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+if args.engine == 'async':
+    print(f"⚡ Async engine: up to {args.concurrency} concurrent requests (adaptive)\n")
+    asyncio.run(run_async_engine(download_tasks, args.concurrency))
+else:
+    run_thread_engine(download_tasks)
 
 # Final save
 save_progress()
@@ -431,6 +1152,7 @@ if error_count > 0:
         print(f"   Index: {error_info.get('index', 'N/A')}")
         print(f"   Date: {error_info.get('date', 'N/A')}")
         print(f"   Error: {error_info.get('error', 'N/A')}")
+        print(f"   Attempts: {len(error_info.get('attempts', [])) or 1}")
     print(f"\n💾 Full error log saved in '{ERROR_LOG_FILE}'.")
 else:
     print("\n🎉 All downloads completed successfully!")
@@ -0,0 +1,166 @@
+"""
+Tests for combine_image in overlay-manager.py
+The lossless-region splice needs jpegtran with -drop and is skipped without it
+"""
+
+import os
+import struct
+import importlib.util
+
+import pytest
+from PIL import Image, ImageDraw
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'overlay-manager.py')
+spec = importlib.util.spec_from_file_location('overlay_manager', SCRIPT)
+overlay_manager = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(overlay_manager)
+
+WIDTH, HEIGHT = 320, 480
+BAND = (0, 200, 320, 250)  # Caption bar of the test overlay
+MCU = 16  # 4:2:0 sampling
+
+requires_jpegtran = pytest.mark.skipif(not overlay_manager.check_jpegtran_drop_available(),
+                                       reason='jpegtran with -drop not installed')
+
+# ==============================================================================
+# HELPERS
+# ==============================================================================
+
+def make_base(path, mode='RGB'):
+    """JPEG with some detail, EXIF and a comment, like a Snapchat frame"""
+    image = Image.new('RGB', (WIDTH, HEIGHT))
+    draw = ImageDraw.Draw(image)
+    for y in range(0, HEIGHT, 8):
+        draw.rectangle((0, y, WIDTH, y + 7), fill=((y * 3) % 256, (y * 7) % 256, (y * 11) % 256))
+    draw.ellipse((40, 40, 280, 440), outline=(255, 255, 255), width=5)
+    exif = Image.Exif()
+    exif[0x0132] = '2023:07:14 18:30:05'
+    exif[0x010f] = 'Snap Inc.'
+    image.convert(mode).save(path, 'JPEG', quality=90, subsampling=2, exif=exif.tobytes(),
+                             comment=b'snapchat memory')
+    return path
+
+def make_overlay(path, visible=True):
+    overlay = Image.new('RGBA', (WIDTH, HEIGHT), (0, 0, 0, 0))
+    if visible:
+        ImageDraw.Draw(overlay).rectangle(BAND, fill=(0, 0, 0, 160))
+    overlay.save(path)
+    return path
+
+def read_segments(path):
+    """[(marker, payload)] of every segment before the scan data"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    segments = []
+    position = 2
+    while position < len(data):
+        marker = data[position + 1]
+        length = struct.unpack('>H', data[position + 2:position + 4])[0]
+        segments.append((marker, data[position + 4:position + 2 + length]))
+        if marker == 0xda:
+            break
+        position += 2 + length
+    return segments
+
+def metadata_segments(path):
+    """APPn (EXIF, JFIF, ...) and COM segments"""
+    return [segment for segment in read_segments(path) if 0xe0 <= segment[0] <= 0xef or segment[0] == 0xfe]
+
+# ==============================================================================
+# LOSSLESS REGION
+# ==============================================================================
+
+@requires_jpegtran
+def test_lossless_region_keeps_pixels_outside_the_patch(tmp_path):
+    base = make_base(str(tmp_path / 'main.jpg'))
+    overlay = make_overlay(str(tmp_path / 'overlay.png'))
+    output = str(tmp_path / 'combined.jpg')
+    
+    assert overlay_manager.combine_image(base, overlay, output, jpeg_mode='lossless-region') == 'lossless-region'
+    
+    # The patch covers the band grown to whole MCUs. Chroma upsampling blends across
+    # block edges, so one MCU on either side of it is not compared
+    top = BAND[1] - BAND[1] % MCU - MCU
+    bottom = -(-BAND[3] // MCU) * MCU + MCU
+    with Image.open(base) as original, Image.open(output) as combined:
+        assert combined.size == original.size
+        for box in ((0, 0, WIDTH, top), (0, bottom, WIDTH, HEIGHT)):
+            assert combined.crop(box).tobytes() == original.crop(box).tobytes()
+        # The caption itself was blended in
+        assert combined.getpixel((160, 225)) != original.getpixel((160, 225))
+
+@requires_jpegtran
+def test_lossless_region_keeps_markers_and_exif(tmp_path):
+    base = make_base(str(tmp_path / 'main.jpg'))
+    overlay = make_overlay(str(tmp_path / 'overlay.png'))
+    output = str(tmp_path / 'combined.jpg')
+    
+    assert overlay_manager.combine_image(base, overlay, output, jpeg_mode='lossless-region') == 'lossless-region'
+    
+    assert metadata_segments(output) == metadata_segments(base)
+    quantization = [segment for segment in read_segments(base) if segment[0] == 0xdb]
+    assert [segment for segment in read_segments(output) if segment[0] == 0xdb] == quantization
+    with Image.open(base) as original, Image.open(output) as combined:
+        assert combined.info['exif'] == original.info['exif']
+
+@requires_jpegtran
+def test_lossless_region_is_smaller_than_reencode(tmp_path):
+    base = make_base(str(tmp_path / 'main.jpg'))
+    overlay = make_overlay(str(tmp_path / 'overlay.png'))
+    lossless = str(tmp_path / 'lossless.jpg')
+    reencoded = str(tmp_path / 'reencoded.jpg')
+    
+    overlay_manager.combine_image(base, overlay, lossless, jpeg_mode='lossless-region')
+    overlay_manager.combine_image(base, overlay, reencoded, jpeg_mode='reencode')
+    
+    assert os.path.getsize(lossless) < os.path.getsize(reencoded)
+
+# ==============================================================================
+# FALLBACKS
+# ==============================================================================
+
+def test_transparent_overlay_copies_the_original(tmp_path):
+    base = make_base(str(tmp_path / 'main.jpg'))
+    overlay = make_overlay(str(tmp_path / 'overlay.png'), visible=False)
+    output = str(tmp_path / 'combined.jpg')
+    
+    assert overlay_manager.combine_image(base, overlay, output, jpeg_mode='lossless-region') == 'lossless-region'
+    
+    with open(base, 'rb') as original, open(output, 'rb') as combined:
+        assert combined.read() == original.read()
+
+def test_grayscale_base_falls_back_to_reencode(tmp_path):
+    base = make_base(str(tmp_path / 'main.jpg'), mode='L')
+    overlay = make_overlay(str(tmp_path / 'overlay.png'))
+    output = str(tmp_path / 'combined.jpg')
+    
+    assert overlay_manager.combine_image(base, overlay, output, jpeg_mode='lossless-region') == 'reencode'
+    
+    with Image.open(output) as combined:
+        assert combined.size == (WIDTH, HEIGHT)
+
+def test_reencode_keeps_exif(tmp_path):
+    base = make_base(str(tmp_path / 'main.jpg'))
+    overlay = make_overlay(str(tmp_path / 'overlay.png'))
+    output = str(tmp_path / 'combined.jpg')
+    
+    assert overlay_manager.combine_image(base, overlay, output) == 'reencode'
+    
+    with Image.open(base) as original, Image.open(output) as combined:
+        assert combined.info['exif'] == original.info['exif']
+
+def test_missing_jpegtran_is_recorded_as_fallback(tmp_path):
+    base = make_base(str(tmp_path / 'main.jpg'))
+    overlay = make_overlay(str(tmp_path / 'overlay.png'))
+    output = str(tmp_path / 'combined.jpg')
+    
+    assert overlay_manager.combine_image(base, overlay, output, jpeg_mode='lossless-region',
+                                         jpegtran_available=False) == 'fallback'
+    
+    state = {}
+    signature = overlay_manager.get_input_signature([base, overlay])
+    params = {'quality': 100, 'jpeg_mode': 'lossless-region'}
+    overlay_manager.record_combined_output(state, 'combined.jpg', signature, params, output, jpeg_mode='fallback')
+    entry = state['combined.jpg']
+    assert overlay_manager.is_output_up_to_date(entry, signature, params, output, jpegtran_available=False)
+    assert not overlay_manager.is_output_up_to_date(entry, signature, params, output, jpegtran_available=True)
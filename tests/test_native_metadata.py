@@ -0,0 +1,228 @@
+"""
+Round-trip tests for native_metadata.py
+Dates and GPS written in-process are read back with Pillow (JPEG) and struct (MP4),
+and compared against exiftool's output when exiftool is installed
+"""
+
+import os
+import sys
+import json
+import shutil
+import struct
+import subprocess
+from datetime import datetime
+
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from native_metadata import write_native_metadata, MP4_EPOCH
+
+DT = datetime(2023, 7, 14, 18, 30, 5)
+EXIF_DATE = '2023:07:14 18:30:05'
+LOCATION = {'latitude': 48.208176, 'longitude': -16.373819}
+
+# ==============================================================================
+# HELPERS
+# ==============================================================================
+
+def make_jpeg(path, exif=None):
+    image = Image.new('RGB', (64, 48), (200, 100, 50))
+    if exif is not None:
+        image.save(path, 'JPEG', quality=90, exif=exif)
+    else:
+        image.save(path, 'JPEG', quality=90)
+    return path
+
+def box(box_type, payload):
+    return struct.pack('>I4s', 8 + len(payload), box_type) + payload
+
+def full_box(box_type, version, payload):
+    return box(box_type, struct.pack('>B3x', version) + payload)
+
+def make_mp4(path, version=0):
+    """Minimal MP4: ftyp, moov (mvhd, one trak with tkhd and mdia/mdhd) and mdat"""
+    if version == 1:
+        times = struct.pack('>QQ', 1, 2)
+    else:
+        times = struct.pack('>II', 1, 2)
+    mvhd = full_box(b'mvhd', version, times + b'\x00' * 88)
+    tkhd = full_box(b'tkhd', version, times + b'\x00' * 72)
+    mdhd = full_box(b'mdhd', version, times + b'\x00' * 12)
+    trak = box(b'trak', tkhd + box(b'mdia', mdhd))
+    with open(path, 'wb') as f:
+        f.write(box(b'ftyp', b'isom\x00\x00\x02\x00isomiso2'))
+        f.write(box(b'moov', mvhd + trak))
+        f.write(box(b'mdat', b'\x00' * 32))
+    return path
+
+def read_mp4_times(path):
+    """{box type: (creation, modification)} read straight from the atoms"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    times = {}
+    for box_type in (b'mvhd', b'tkhd', b'mdhd'):
+        offset = data.index(box_type) + 4
+        version = data[offset]
+        if version == 1:
+            times[box_type] = struct.unpack_from('>QQ', data, offset + 4)
+        else:
+            times[box_type] = struct.unpack_from('>II', data, offset + 4)
+    return times
+
+def read_gps(exif):
+    gps = exif.get_ifd(0x8825)
+    def degrees(dms, ref):
+        value = float(dms[0]) + float(dms[1]) / 60 + float(dms[2]) / 3600
+        return -value if ref in ('S', 'W') else value
+    return degrees(gps[2], gps[1]), degrees(gps[4], gps[3])
+
+def exiftool_read(path, *tags):
+    result = subprocess.run(['exiftool', '-j', '-n', *tags, path], capture_output=True, text=True, check=True)
+    data = json.loads(result.stdout)[0]
+    data.pop('SourceFile', None)
+    return data
+
+# ==============================================================================
+# JPEG
+# ==============================================================================
+
+def test_jpeg_date_round_trip(tmp_path):
+    path = make_jpeg(str(tmp_path / 'date.jpg'))
+    
+    assert write_native_metadata(path, DT)
+    
+    with Image.open(path) as image:
+        exif = image.getexif()
+        exif_ifd = exif.get_ifd(0x8769)
+        assert exif[0x0132] == EXIF_DATE
+        assert exif_ifd[0x9003] == EXIF_DATE
+        assert exif_ifd[0x9004] == EXIF_DATE
+        image.load()
+
+def test_jpeg_gps_round_trip(tmp_path):
+    path = make_jpeg(str(tmp_path / 'gps.jpg'))
+    
+    assert write_native_metadata(path, DT, LOCATION)
+    
+    with Image.open(path) as image:
+        latitude, longitude = read_gps(image.getexif())
+    assert latitude == pytest.approx(LOCATION['latitude'], abs=1e-6)
+    assert longitude == pytest.approx(LOCATION['longitude'], abs=1e-6)
+
+def test_jpeg_keeps_existing_tags_and_pixels(tmp_path):
+    exif = Image.Exif()
+    exif[0x010f] = 'Snap Inc.'  # Make
+    exif[0x0112] = 6  # Orientation
+    path = make_jpeg(str(tmp_path / 'tags.jpg'), exif=exif.tobytes())
+    with Image.open(path) as image:
+        pixels = image.tobytes()
+    
+    assert write_native_metadata(path, DT, LOCATION)
+    
+    with Image.open(path) as image:
+        exif = image.getexif()
+        assert exif[0x010f] == 'Snap Inc.'
+        assert exif[0x0112] == 6
+        assert exif[0x0132] == EXIF_DATE
+        assert image.tobytes() == pixels
+
+def test_jpeg_rewrite_patches_in_place(tmp_path):
+    path = make_jpeg(str(tmp_path / 'twice.jpg'))
+    assert write_native_metadata(path, datetime(2020, 1, 1), LOCATION)
+    size = os.path.getsize(path)
+    
+    assert write_native_metadata(path, DT, {'latitude': -33.86, 'longitude': 151.21})
+    
+    assert os.path.getsize(path) == size
+    with Image.open(path) as image:
+        exif = image.getexif()
+        assert exif[0x0132] == EXIF_DATE
+        latitude, longitude = read_gps(exif)
+    assert latitude == pytest.approx(-33.86, abs=1e-6)
+    assert longitude == pytest.approx(151.21, abs=1e-6)
+
+# ==============================================================================
+# MP4
+# ==============================================================================
+
+@pytest.mark.parametrize('version', [0, 1])
+def test_mp4_date_round_trip(tmp_path, version):
+    path = make_mp4(str(tmp_path / f'v{version}.mp4'), version)
+    seconds = int((DT - MP4_EPOCH).total_seconds())
+    
+    assert write_native_metadata(path, DT)
+    
+    times = read_mp4_times(path)
+    assert times[b'mvhd'] == (seconds, seconds)
+    assert times[b'tkhd'] == (seconds, 2)
+    assert times[b'mdhd'] == (seconds, 2)
+
+def test_mp4_with_location_is_left_to_exiftool(tmp_path):
+    path = make_mp4(str(tmp_path / 'gps.mp4'))
+    with open(path, 'rb') as f:
+        original = f.read()
+    
+    assert not write_native_metadata(path, DT, LOCATION)
+    
+    with open(path, 'rb') as f:
+        assert f.read() == original
+
+def test_mp4_without_moov_is_left_alone(tmp_path):
+    path = str(tmp_path / 'broken.mp4')
+    with open(path, 'wb') as f:
+        f.write(box(b'ftyp', b'isom') + box(b'mdat', b'\x00' * 16))
+    
+    assert not write_native_metadata(path, DT)
+
+def test_unsupported_format_is_left_to_exiftool(tmp_path):
+    path = str(tmp_path / 'image.png')
+    Image.new('RGB', (8, 8)).save(path)
+    
+    assert not write_native_metadata(path, DT)
+
+# ==============================================================================
+# EXIFTOOL COMPARISON
+# ==============================================================================
+
+@pytest.mark.skipif(shutil.which('exiftool') is None, reason='exiftool not installed')
+def test_jpeg_matches_exiftool(tmp_path):
+    native_path = make_jpeg(str(tmp_path / 'native.jpg'))
+    exiftool_path = make_jpeg(str(tmp_path / 'exiftool.jpg'))
+    
+    assert write_native_metadata(native_path, DT, LOCATION)
+    subprocess.run(
+        ['exiftool', '-overwrite_original', '-q',
+         f'-DateTimeOriginal={EXIF_DATE}', f'-CreateDate={EXIF_DATE}', f'-ModifyDate={EXIF_DATE}',
+         f'-GPSLatitude={abs(LOCATION["latitude"])}', '-GPSLatitudeRef=N',
+         f'-GPSLongitude={abs(LOCATION["longitude"])}', '-GPSLongitudeRef=W',
+         exiftool_path],
+        check=True
+    )
+    
+    tags = ('-DateTimeOriginal', '-CreateDate', '-ModifyDate', '-GPSLatitude', '-GPSLongitude')
+    native = exiftool_read(native_path, *tags)
+    expected = exiftool_read(exiftool_path, *tags)
+    assert native['DateTimeOriginal'] == expected['DateTimeOriginal']
+    assert native['CreateDate'] == expected['CreateDate']
+    assert native['ModifyDate'] == expected['ModifyDate']
+    assert native['GPSLatitude'] == pytest.approx(expected['GPSLatitude'], abs=1e-6)
+    assert native['GPSLongitude'] == pytest.approx(expected['GPSLongitude'], abs=1e-6)
+
+@pytest.mark.skipif(shutil.which('exiftool') is None, reason='exiftool not installed')
+def test_mp4_matches_exiftool(tmp_path):
+    native_path = make_mp4(str(tmp_path / 'native.mp4'))
+    exiftool_path = make_mp4(str(tmp_path / 'exiftool.mp4'))
+    
+    assert write_native_metadata(native_path, DT)
+    subprocess.run(
+        ['exiftool', '-overwrite_original', '-q',
+         f'-CreateDate={EXIF_DATE}', f'-MediaCreateDate={EXIF_DATE}',
+         f'-TrackCreateDate={EXIF_DATE}', f'-ModifyDate={EXIF_DATE}',
+         exiftool_path],
+        check=True
+    )
+    
+    tags = ('-CreateDate', '-ModifyDate', '-TrackCreateDate', '-MediaCreateDate')
+    assert exiftool_read(native_path, *tags) == exiftool_read(exiftool_path, *tags)